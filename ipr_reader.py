@@ -0,0 +1,373 @@
+"""
+Set of readers for the custom InterPro files written by ipr_updater
+for use with the Anatomizer.
+
+Files are streamed element by element and never loaded as a whole
+document tree. The first lookup builds an index of the offset of each 
+record in a single pass, so that later lookups read one record only.
+Records found are kept in a LRU cache.
+"""
+
+
+import re
+import gzip
+import bisect
+from collections import namedtuple
+from functools import lru_cache
+from lxml import etree
+
+import ipr_updater as ipru
+
+
+# Records of refs_mapping.
+Isoform = namedtuple('Isoform', 'id length type')
+MappingEntry = namedtuple('MappingEntry',
+                          'uniprot_ac hgnc_symbol hgnc_id synonyms isoforms')
+
+# Records of ipr_shortnames.
+ShortName = namedtuple('ShortName', 'id short_name name parent type')
+
+# Records of ipr_hierarchy.
+Hierarchy = namedtuple('Hierarchy',
+                       'id parents ancestors depth root left right')
+
+# Records of ipr_reviewed_human_match and ipr_canonical_human_match.
+Location = namedtuple('Location', 'start end score')
+Match = namedtuple('Match', 'id name dbname status ipr ipr_type locations')
+Protein = namedtuple('Protein', 'id name length crc64 matches')
+
+# Records of the shard directory of ipr_reviewed_human_match.
+Shard = namedtuple('Shard', 'index first_ac last_ac entries file')
+
+
+# Records of ipr_domain_summary.
+Domain = namedtuple('Domain', 'ipr start end')
+DomainSummary = namedtuple('DomainSummary', 'id length domains')
+
+
+def mapping_entry(element):
+    """ Convert an <entry> element of refs_mapping to a MappingEntry. """
+    synonyms = [synonym.text for synonym in element.iterfind('synonym')]
+    isoforms = [Isoform(isoform.findtext('id'),
+                        int(isoform.findtext('length')),
+                        isoform.findtext('type'))
+                for isoform in element.iterfind('isoform')]
+    return MappingEntry(element.get('uniprot_ac'), element.get('hgnc_symbol'),
+                        element.get('hgnc_id'), synonyms, isoforms)
+
+
+def shortname_entry(element):
+    """ Convert an <interpro> element of ipr_shortnames to a ShortName. """
+    parent = element.get('parent')
+    if parent == 'None':
+        parent = None
+    return ShortName(element.get('id'), element.get('short_name'),
+                     element.get('name'), parent, element.get('type'))
+
+
+def hierarchy_entry(element):
+    """ Convert an <interpro> element of ipr_hierarchy to a Hierarchy. """
+    left = element.get('left')
+    right = element.get('right')
+    return Hierarchy(element.get('id'), element.get('parents').split(),
+                     element.get('ancestors').split(), 
+                     int(element.get('depth')), element.get('root'),
+                     int(left) if left else None,
+                     int(right) if right else None)
+
+
+def protein_entry(element):
+    """ Convert a <protein> element of a match file to a Protein. """
+    matches = []
+    for match in element.iterfind('match'):
+        ipr = match.find('ipr')
+        if ipr is not None:
+            ipr_id, ipr_type = ipr.get('id'), ipr.get('type')
+        else:
+            ipr_id, ipr_type = None, None
+        locations = [Location(int(lcn.get('start')), int(lcn.get('end')),
+                              lcn.get('score'))
+                     for lcn in match.iterfind('lcn')]
+        matches.append(Match(match.get('id'), match.get('name'),
+                             match.get('dbname'), match.get('status'),
+                             ipr_id, ipr_type, locations))
+    return Protein(element.get('id'), element.get('name'),
+                   int(element.get('length')), element.get('crc64'), matches)
+
+
+def summary_entry(element):
+    """ Convert a <protein> element of ipr_domain_summary. """
+    domains = [Domain(domain.get('ipr'), int(domain.get('start')),
+                      int(domain.get('end')))
+               for domain in element.iterfind('domain')]
+    return DomainSummary(element.get('id'), int(element.get('length')),
+                         domains)
+
+
+class Reader:
+    """
+    Base class of the readers. Subclasses give the tag of the records,
+    the function 'convert' that turns an element into a record and the 
+    attribute of the element used as key for lookups.
+
+    Lookups go through an index of the offset of each record in the 
+    decompressed file, built by the first lookup in one pass. A key absent
+    from the index is answered without reading the file. The cost of the
+    other lookups depends on the codec of the file:
+    - bgzf or none: a single seek, then the record is read;
+    - gzip, xz or zstd: the file is decompressed from its start up to the 
+      record (without parsing it). Use lookup_many to read several 
+      records in a single pass, or write the file with codec bgzf.
+    """
+    tag = None
+    key = None
+    convert = None
+
+    def __init__(self, path, cache_size=4096):
+        self.path = path
+        self.codec = ipru.detect_codec(path)
+        self.index = None
+        self.blocks = None
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __iter__(self):
+        for element in ipru.iter_records(self.path, self.tag):
+            yield self.convert(element)
+
+    def build_index(self):
+        """ Find the offset of each record in a single pass. """
+        start = ('<%s ' % self.tag).encode('utf-8')
+        key = re.compile((' %s="([^"]*)"' % self.key).encode('utf-8'))
+        self.index = {}
+        offset = 0
+        with ipru.open_compressed(self.path) as infile:
+            for line in infile:
+                if start in line:
+                    found = key.search(line)
+                    if found:
+                        self.index[found.group(1).decode('utf-8')] = offset
+                offset += len(line)
+        if self.codec == 'bgzf':
+            self.blocks = ipru.bgzf_blocks(self.path)
+            self.block_starts = [block[0] for block in self.blocks]
+
+    def seekable(self):
+        """ Check if a record can be reached with a single seek. """
+        return self.codec in ('bgzf', 'none')
+
+    def read_lines(self, infile):
+        """ Read the lines of the record at the position of 'infile'. """
+        end_tag = ('</%s>' % self.tag).encode('utf-8')
+        lines = []
+        for line in infile:
+            lines.append(line)
+            if end_tag in line or (len(lines) == 1 
+                                   and line.rstrip().endswith(b'/>')):
+                break
+        return lines
+
+    def read_record(self, offset):
+        """ Read and convert the record starting at 'offset'. """
+        if self.codec == 'bgzf':
+            i = bisect.bisect_right(self.block_starts, offset) - 1
+            block_start, file_offset = self.blocks[i]
+            with open(self.path, 'rb') as raw:
+                raw.seek(file_offset)
+                with gzip.GzipFile(fileobj=raw, mode='rb') as infile:
+                    infile.read(offset - block_start)
+                    lines = self.read_lines(infile)
+        else:
+            with ipru.open_compressed(self.path) as infile:
+                if self.codec == 'none':
+                    infile.seek(offset)
+                else:
+                    skip(infile, offset)
+                lines = self.read_lines(infile)
+        return self.convert(etree.fromstring(b''.join(lines)))
+
+    def _lookup(self, key):
+        """ Find the record with given key, None if it is not in the file. """
+        if self.index is None:
+            self.build_index()
+        offset = self.index.get(key)
+        if offset is None:
+            return None
+        return self.read_record(offset)
+
+    def lookup_many(self, keys):
+        """ 
+        Find the records of several keys, in the order of the file. 
+        Without a single seek per record, the file is read in one pass.
+        """
+        if self.index is None:
+            self.build_index()
+        found = sorted((self.index[key], key) for key in set(keys) 
+                       if key in self.index)
+        records = {}
+        if self.seekable():
+            for offset, key in found:
+                records[key] = self.lookup(key)
+            return records
+
+        position = 0
+        with ipru.open_compressed(self.path) as infile:
+            for offset, key in found:
+                skip(infile, offset - position)
+                lines = self.read_lines(infile)
+                position = offset + sum(len(line) for line in lines)
+                records[key] = self.convert(etree.fromstring(b''.join(lines)))
+        return records
+
+
+def skip(infile, size):
+    """ Skip 'size' bytes of a decompressed stream, by blocks. """
+    while size > 0:
+        block = infile.read(min(size, 1048576))
+        if not block:
+            break
+        size -= len(block)
+
+
+class MappingReader(Reader):
+    """ Reader of refs_mapping, with lookups by UniProt AC. """
+    tag = 'entry'
+    key = 'uniprot_ac'
+    convert = staticmethod(mapping_entry)
+
+
+class ShortNameReader(Reader):
+    """ Reader of ipr_shortnames, with lookups by InterPro id. """
+    tag = 'interpro'
+    key = 'id'
+    convert = staticmethod(shortname_entry)
+
+    def shortname(self, ipr):
+        entry = self.lookup(ipr)
+        return entry.short_name if entry else None
+
+    def parent(self, ipr):
+        entry = self.lookup(ipr)
+        return entry.parent if entry else None
+
+
+class HierarchyReader(Reader):
+    """ Reader of ipr_hierarchy, with lookups by InterPro id. """
+    tag = 'interpro'
+    key = 'id'
+    convert = staticmethod(hierarchy_entry)
+
+    def root(self, ipr):
+        entry = self.lookup(ipr)
+        return entry.root if entry else None
+
+    def is_ancestor(self, ancestor, ipr):
+        """
+        Check if 'ancestor' is an ancestor of 'ipr' through any parent.
+        The Euler tour intervals, which cover first parents only, answer
+        in constant time when both entries have them; the list of 
+        ancestors of 'ipr' is checked otherwise.
+        """
+        entry = self.lookup(ipr)
+        if entry is None:
+            return False
+        other = self.lookup(ancestor)
+        if (entry.left is not None and other is not None 
+                and other.left is not None and other.left < entry.left 
+                and entry.right <= other.right):
+            return True
+        return ancestor in entry.ancestors
+
+
+class MatchReader(Reader):
+    """
+    Reader of ipr_reviewed_human_match or ipr_canonical_human_match,
+    with lookups by UniProt AC (or isoform id).
+    """
+    tag = 'protein'
+    key = 'id'
+    convert = staticmethod(protein_entry)
+
+
+class DomainSummaryReader(Reader):
+    """ Reader of ipr_domain_summary, with lookups by UniProt AC. """
+    tag = 'protein'
+    key = 'id'
+    convert = staticmethod(summary_entry)
+
+
+def read_shards(path):
+    """ Read the shard directory ipr_reviewed_human_match-<version>-shards.txt. """
+    shards = []
+    with open(path) as infile:
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            index, first_ac, last_ac, entries, filename = line.split()
+            shards.append(Shard(int(index), first_ac, last_ac, 
+                                int(entries), filename))
+    return shards
+
+
+def find_shard(shards, uniprot_ac):
+    """ 
+    Find the shard whose range of accessions contains 'uniprot_ac'.
+    Return None if it is outside of every range.
+    """
+    firsts = [shard.first_ac for shard in shards]
+    i = bisect.bisect_right(firsts, uniprot_ac) - 1
+    if i < 0 or uniprot_ac > shards[i].last_ac:
+        return None
+    return shards[i]
+
+
+def removed_ids(delta_path):
+    """ Read the ids of the entries removed by ipr_match_delta. """
+    removed = set()
+    pattern = re.compile(b'<removed id="([^"]*)"/>')
+    with ipru.open_compressed(delta_path) as delta_in:
+        for line in delta_in:
+            found = pattern.search(line)
+            if found:
+                removed.add(found.group(1).decode('utf-8'))
+    return removed
+
+
+def apply_match_delta(base_path, delta_path, out_path, codec=None):
+    """
+    Rebuild ipr_reviewed_human_match of version N from the file of 
+    version M and ipr_match_delta-M-N, both sorted by UniProt AC, and 
+    write it to 'out_path' (with the codec of the base file by default).
+    Return the number of entries written.
+    """
+    removed = removed_ids(delta_path)
+    if codec is None:
+        codec = ipru.detect_codec(base_path)
+    entries = 0
+    with ipru.open_compressed(base_path) as base_in, \
+         ipru.open_compressed(delta_path) as delta_in, \
+         ipru.XmlWriter(out_path, codec=codec) as out:
+        out.write('<interpromatch>\n')
+        changes = ipru.protein_blocks(delta_in)
+        change_ac, change = next(changes, (None, None))
+        previous_ac = ''
+        for uniprot_ac, block in ipru.protein_blocks(base_in):
+            if uniprot_ac <= previous_ac:
+                raise ipru.IprUpdaterError('%s is not sorted by accession.'
+                                           % base_path)
+            previous_ac = uniprot_ac
+            # Entries added before this one, then this one if it changed.
+            while change_ac is not None and change_ac <= uniprot_ac:
+                out.write(change)
+                entries += 1
+                if change_ac == uniprot_ac:
+                    block = None
+                change_ac, change = next(changes, (None, None))
+            if block is not None and uniprot_ac not in removed:
+                out.write(block)
+                entries += 1
+        while change_ac is not None:
+            out.write(change)
+            entries += 1
+            change_ac, change = next(changes, (None, None))
+        out.write('</interpromatch>\n')
+    return entries
@@ -9,13 +9,34 @@ import sys
 import re
 import math
 import time
+import io
 import gzip
 import csv
+import json
 import shutil
+import zlib
+import mmap
+import struct
+import heapq
+import tempfile
+import bisect
+import hashlib
 import urllib.request # "import requests" does not work for FTP
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor
 import lxml.html
 from lxml import etree
 
+# Optional compression modules for the custom files.
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class IprUpdaterError(Exception):
     """Base class for exception."""
@@ -33,6 +54,307 @@ def ipr_mkdir(dldir, wrtdir):
 #............................................................................
 
 
+# Serializer shared by the functions that write custom xml files.
+#
+# Records are built as lists of string pieces, joined once, and appended
+# to a reusable byte buffer. The buffer is handed to the compressor only
+# by large blocks, so the cost of writing no longer depends on the number
+# of small fields in a record.
+#............................................................................
+XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                             '"': '&quot;', "'": '&apos;'})
+
+
+def xml_escape(text):
+    """ Escape all xml special characters of 'text' in a single pass. """
+    return text.translate(XML_ESCAPES)
+
+
+class XmlWriter:
+    """
+    Write xml text to a compressed file through a reusable byte buffer.
+    The buffer is flushed to the compressor once it holds 'blocksize' bytes.
+    The compression is given by 'codec' (see get_codec), gzip by default.
+    Records written with write_record are counted in 'records'.
+    """
+
+    def __init__(self, path, blocksize=1048576, codec=None):
+        self.codec = get_codec(codec)
+        self.outfile = self.codec.open(path, 'wb')
+        self.blocksize = blocksize
+        self.buffer = bytearray()
+        self.records = 0
+
+    def write(self, text):
+        """ 
+        Append text (str, or bytes-like such as a memoryview slice)
+        to the buffer, flush it if it is large enough.
+        """
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        self.buffer += text
+        if len(self.buffer) >= self.blocksize:
+            self.flush()
+
+    def write_record(self, parts):
+        """ Write a record given as a list of string pieces, and count it. """
+        self.write(''.join(parts))
+        self.records += 1
+
+    def flush(self):
+        """ Send the content of the buffer to the compressor. """
+        self.outfile.write(self.buffer)
+        del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+#............................................................................
+
+
+# Compression codecs of the custom files.
+#
+# Every custom file is written through a Codec and read back with 
+# open_compressed, which recognizes the codec from the first bytes of the 
+# file. Available codecs are gzip, bgzf (gzip written in independent blocks 
+# of 64 KB, readable by any gzip reader and splittable by match_regions), 
+# xz (if module lzma is available) and zstd (if module zstandard is 
+# installed). A codec is given as 'name' or 'name:level'.
+#............................................................................
+class Codec:
+    """ Name, file suffix, compression level and opener of a codec. """
+
+    def __init__(self, name, suffix, opener, level=None):
+        self.name = name
+        self.suffix = suffix
+        self.opener = opener
+        self.level = level
+
+    def open(self, path, mode='rb'):
+        return self.opener(path, mode, self.level)
+
+    def __str__(self):
+        if self.level is None:
+            return self.name
+        return '%s:%i' % (self.name, self.level)
+
+
+class BgzfWriter:
+    """
+    Write a BGZF file: a series of gzip members, each holding at most 
+    65280 bytes of data and recording its own size in a 'BC' extra field.
+    """
+    block_size = 65280
+
+    def __init__(self, path, level=None):
+        self.outfile = open(path, 'wb')
+        self.level = 6 if level is None else level
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+        while len(self.pending) >= self.block_size:
+            self.write_block(bytes(self.pending[:self.block_size]))
+            del self.pending[:self.block_size]
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 
+                             66, 67, 2, len(deflated) + 25)
+        self.outfile.write(header)
+        self.outfile.write(deflated)
+        self.outfile.write(struct.pack('<2I', zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self.pending:
+            self.write_block(bytes(self.pending))
+            del self.pending[:]
+        # An empty block marks the end of the file.
+        self.write_block(b'')
+        self.outfile.close()
+
+
+def bgzf_blocks(path):
+    """
+    List the uncompressed start and the offset in the file of each block 
+    of a BGZF file. Only the block headers and trailers are read.
+    """
+    blocks = []
+    start = 0
+    offset = 0
+    with open(path, 'rb') as infile:
+        header = infile.read(18)
+        while len(header) == 18:
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            infile.seek(offset + block_size - 4)
+            data_size = struct.unpack('<I', infile.read(4))[0]
+            blocks.append((start, offset))
+            start += data_size
+            offset += block_size
+            header = infile.read(18)
+    return blocks
+
+
+def open_gzip(path, mode, level):
+    return gzip.open(path, mode, compresslevel=9 if level is None else level)
+
+
+def open_bgzf(path, mode, level):
+    if 'r' in mode:
+        return gzip.open(path, mode)
+    return BgzfWriter(path, level)
+
+
+def open_xz(path, mode, level):
+    if 'r' in mode:
+        return lzma.open(path, mode)
+    return lzma.open(path, mode, preset=level)
+
+
+def open_zstd(path, mode, level):
+    if 'r' in mode:
+        # The decompression reader has no readline, the buffer adds it.
+        return io.BufferedReader(zstandard.open(path, mode))
+    compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+    return zstandard.open(path, mode, cctx=compressor)
+
+
+def open_plain(path, mode, level):
+    return open(path, mode)
+
+
+# Codec name: (file suffix, opener, module is available).
+CODECS = {'gzip': ('.gz', open_gzip, True),
+          'bgzf': ('.gz', open_bgzf, True),
+          'xz': ('.xz', open_xz, lzma is not None),
+          'zstd': ('.zst', open_zstd, zstandard is not None),
+          'none': ('', open_plain, True)}
+
+# Codec name: (lowest, highest, default) compression level.
+CODEC_LEVELS = {'gzip': (0, 9, 9),
+                'bgzf': (0, 9, 6),
+                'xz': (0, 9, 6),
+                'zstd': (1, 22, 3)}
+
+CODEC_SUFFIXES = ('.gz', '.xz', '.zst')
+
+# Errors raised by the decompressors on a corrupted file.
+STREAM_ERRORS = (OSError, EOFError, zlib.error)
+if lzma is not None:
+    STREAM_ERRORS += (lzma.LZMAError,)
+if zstandard is not None:
+    STREAM_ERRORS += (zstandard.ZstdError,)
+
+
+def get_codec(spec=None):
+    """
+    Get the Codec of a specification 'name' or 'name:level'.
+    None gives gzip at its default level, a Codec is returned as is.
+    Without a level, the default level of the codec is used (see 
+    CODEC_LEVELS), so that str(codec) always tells the level.
+    """
+    if isinstance(spec, Codec):
+        return spec
+    if spec is None:
+        spec = 'gzip'
+    name, colon, level = spec.partition(':')
+    if name not in CODECS:
+        raise IprUpdaterError('Unknown codec %s, expected one of %s.'
+                              % (name, ', '.join(CODECS)))
+    suffix, opener, available = CODECS[name]
+    if not available:
+        raise IprUpdaterError('Codec %s needs a module that is not '
+                              'installed.' % name)
+    if name not in CODEC_LEVELS:
+        if colon:
+            raise IprUpdaterError('Codec %s takes no level.' % name)
+        return Codec(name, suffix, opener)
+    lowest, highest, default = CODEC_LEVELS[name]
+    if not colon:
+        return Codec(name, suffix, opener, default)
+    try:
+        level = int(level)
+    except ValueError:
+        level = None
+    if level is None or not lowest <= level <= highest:
+        raise IprUpdaterError('Invalid level in codec %s, %s takes a level '
+                              'from %i to %i.' % (spec, name, lowest, highest))
+    return Codec(name, suffix, opener, level)
+
+
+def detect_codec(path):
+    """ Recognize the codec of a file from its first bytes. """
+    with open(path, 'rb') as infile:
+        head = infile.read(18)
+    if head[:2] == b'\x1f\x8b':
+        # BGZF members have extra field 'BC' (flag 4).
+        if len(head) == 18 and head[3] & 4 and head[12:14] == b'BC':
+            return 'bgzf'
+        return 'gzip'
+    if head[:6] == b'\xfd7zXZ\x00':
+        return 'xz'
+    if head[:4] == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return 'none'
+
+
+def open_compressed(path):
+    """ Open a custom file for reading in binary mode, whatever its codec. """
+    return get_codec(detect_codec(path)).open(path, 'rb')
+
+
+def strip_codec_suffix(filename):
+    """ Remove the codec suffix (.gz, .xz, .zst) of a file name. """
+    for suffix in CODEC_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def find_artifact(wrtdir, name):
+    """ 
+    Find the path of custom file 'name' (ending with .xml) 
+    in 'wrtdir', whatever codec it was written with. 
+    """
+    for suffix in CODEC_SUFFIXES + ('',):
+        path = '%s/%s%s' % (wrtdir, name, suffix)
+        if os.path.exists(path):
+            return path
+    raise IprUpdaterError('File %s/%s not found with any codec.' 
+                          % (wrtdir, name))
+#............................................................................
+
+
+# Input files are normally gzip files. An uncompressed copy of a large 
+# input (for example match_complete.xml decompressed once from gzip or 
+# zstd) is used instead when it exists next to the gzip file. It is then 
+# read through mmap, which avoids inflating the file at every run.
+#............................................................................
+def input_path(path):
+    """
+    Return 'path' without its .gz extension if an uncompressed copy 
+    of the file exists, otherwise return 'path'.
+    """
+    if path.endswith('.gz') and os.path.exists(path[:-3]):
+        return path[:-3]
+    return path
+
+
+def open_input(path):
+    """ Open a gzip or uncompressed input file in binary mode. """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'r')
+    return open(path, 'rb')
+#............................................................................
+
+
 # 1. Set of functions to fetch files from InterPro and UniProt.
 #
 # Files to fetch if InterPro file is found to have a new version:
@@ -118,20 +440,101 @@ def local_version(directory, prefix, suffix, avoid=None):
     return loc_version
 
 
-def online_version():
-    """ Check last version of InterPro online. """
-    ipr_home = urllib.request.urlopen('https://www.ebi.ac.uk/interpro/')
-    content = ipr_home.read()
+def file_versions(directory, prefix, suffix):
+    """
+    List in increasing order the versions of the files of 'directory' 
+    named <prefix><version><suffix>, followed by any codec suffix.
+    """
+    pattern = re.compile('%s(\\d+)%s$' % (re.escape(prefix), 
+                                           re.escape(suffix)))
+    versions = []
+    for filename in os.listdir(directory):
+        found = pattern.match(strip_codec_suffix(filename))
+        if found:
+            versions.append(int(found.group(1)))
+    return sorted(versions)
+
+
+def cached_probe(url, parse, cachefile=None, ttl=3600):
+    """
+    Return the value parsed from the content at 'url' with function 'parse'.
+    The value is kept in json file 'cachefile' with the ETag and 
+    Last-Modified headers of the answer. A value younger than 'ttl' seconds
+    is returned without any request. Otherwise a conditional request is 
+    sent, and if the content did not change the server only answers 304.
+    """
+    cache = {}
+    if cachefile and os.path.exists(cachefile):
+        with open(cachefile) as infile:
+            cache = json.load(infile)
+    entry = cache.get(url)
+
+    now = time.time()
+    if entry and now - entry['checked'] < ttl:
+        return entry['value']
+
+    request = urllib.request.Request(url)
+    if entry and entry['etag']:
+        request.add_header('If-None-Match', entry['etag'])
+    if entry and entry['last_modified']:
+        request.add_header('If-Modified-Since', entry['last_modified'])
+    try:
+        answer = urllib.request.urlopen(request, timeout=60)
+        value = parse(answer.read())
+        entry = {'etag': answer.headers.get('ETag'),
+                 'last_modified': answer.headers.get('Last-Modified'),
+                 'value': value}
+    except urllib.error.HTTPError as error:
+        # Content not modified since cached value.
+        if error.code != 304 or not entry:
+            raise
+    entry['checked'] = now
+
+    if cachefile:
+        cache[url] = entry
+        with open('%s.tmp' % cachefile, 'w') as outfile:
+            json.dump(cache, outfile, indent=1)
+        os.replace('%s.tmp' % cachefile, cachefile)
+
+    return entry['value']
+
+
+def parse_ipr_home(content):
+    """ Find the InterPro version in the html of the InterPro home page. """
     tree = lxml.etree.HTML(content)
     release = tree.find(".//div[@class='release-box']")
     latest_rel = release.find(".//span[@class='version_title_main']")
     ipr_version = latest_rel.text
     tokens = ipr_version.split()
-    onl_version = int(float(tokens[1]))
+    return int(float(tokens[1]))
+
+
+def online_version(cachefile=None, ttl=3600):
+    """ 
+    Check last version of InterPro online. 
+    If 'cachefile' is given, the version is cached for 'ttl' seconds and
+    then revalidated with a conditional request.
+    """
+    onl_version = cached_probe('https://www.ebi.ac.uk/interpro/', 
+                               parse_ipr_home, cachefile, ttl)
 
     return onl_version
 
 
+def needs_update(wrtdir, cachefile=None, ttl=3600):
+    """
+    Quick check that a new InterPro version is online and that custom files
+    were not already written for it. The manifest is put in place last by 
+    update_ipr.py, once the files pass verification, so its version is 
+    the one of the last complete update.
+    """
+    done_version = 0
+    versions = file_versions(wrtdir, 'manifest-', '.json')
+    if versions:
+        done_version = read_manifest(versions[-1], wrtdir)['version']
+    return online_version(cachefile, ttl) > done_version
+
+
 def fetch_match(version, dldir):
     """ Download match_complete.xml.gz. """
     urllib.request.urlretrieve('ftp://ftp.ebi.ac.uk/pub/databases/interpro/'
@@ -201,37 +604,21 @@ def check_dates(version, dldir):
     return date_ext
 
 
-def update_mapping(version, dldir, wrtdir):
-    """
-    Write an xml file that contains the UniProt id, HGNC symbol, HGNC id, 
-    HGNC synonyms and isoforms for each reviewed human proteome UniProt entry.
-    """
-    date = check_dates(version, dldir)
+class UnsortedInputError(IprUpdaterError):
+    """ Input files are not sorted by accession as expected. """
 
-    # Input files.
-    tsvfile = gzip.open('%s/uniprot-hproteome-%i-%s.tsv.gz'
-                        % (dldir, version, date), 'rt')
-    fastafile = gzip.open('%s/uniprot-hproteome-%i-%s.fasta.gz'
-                          % (dldir, version, date), 'rt')
-    
-    # Output file
-    outfile = gzip.open('%s/refs-tmp_mapping-%i.xml.gz'
-                        % (wrtdir, version), 'wt')
 
-    # Running options message.
-    print('Extracting information from %s/' % dldir)
-    print('uniprot-hproteome-%i-%s.tsv.gz' % (version, date) )
-    print('uniprot-hproteome-%i-%s.fasta.gz' % (version, date) )
-    
-    # Get the length of each isoform by counting the 
-    # number of residues in fasta entry.
-    isoform_lengths = {}
+def fasta_lengths(fastafile):
+    """
+    Get the length of each isoform by counting the 
+    number of residues in fasta entry. Yield isoform id and length.
+    """
     first = True
     for line in fastafile:
-        if '>sp' in line:
+        if line.startswith('>'):
     
             if not first:
-                isoform_lengths[isoform_id] = l
+                yield isoform_id, l
             first = False
     
             pipe = line.index('|')+1
@@ -241,82 +628,257 @@ def update_mapping(version, dldir, wrtdir):
         else:
             l += len(line) - 1
     # For the last entry
-    isoform_lengths[isoform_id] = l
-    
-    outfile.write('<mapping>\n')
-    
+    if not first:
+        yield isoform_id, l
+
+
+def fasta_groups(lengths):
+    """
+    Group the isoform lengths of consecutive fasta entries by UniProt AC.
+    Yield the AC and a dictionary of the lengths of its isoforms.
+    Raise UnsortedInputError if ACs are not in increasing order.
+    """
+    group_ac = None
+    group = {}
+    for isoform_id, l in lengths:
+        uniprot_ac = isoform_id.split('-')[0]
+        if uniprot_ac != group_ac:
+            if group_ac is not None:
+                if uniprot_ac < group_ac:
+                    raise UnsortedInputError('Fasta entries are not sorted.')
+                yield group_ac, group
+            group_ac = uniprot_ac
+            group = {}
+        group[isoform_id] = l
+    if group_ac is not None:
+        yield group_ac, group
+
+
+def tsv_entries(tsvfile):
+    """ Yield the entries of the tsv file, without its header line. """
     reader = csv.reader(tsvfile, delimiter='\t')
     first = True
     for entry in reader:
-        if not first: 
-            uniprot_ac = entry[0]
-            hgnc_symbol = entry[1]
-            hgnc_synonyms = entry[2]
-            hgnc_id = entry[3][:-1]
-            alt_prods = entry[4]
-    
-            synonyms = hgnc_synonyms.split()
-            
-            # Process the "ALTERNATIVE PRODUCTS" part of entry.
-            isoform_info = alt_prods.split(';')
-            isoforms = []
-            seq_types = []
-            if len(isoform_info) > 1:
-                for field in isoform_info:
-                    if 'IsoId' in field:
-                        equal_sign = field.index('=')
-                        # Sometimes, there are other ids for a same isoform.
-                        # I just take the first it these cases.
-                        try:
-                            coma = field.index(',')
-                            isoform_id = field[equal_sign+1:coma]
-                        except:
-                            isoform_id = field[equal_sign+1:]
-                        isoforms.append(isoform_id)
-                    if 'Sequence' in field:
-                        equal_sign = field.index('=')
-                        seq_string = field[equal_sign+1:]
-                        if seq_string == 'Displayed':
-                            seq_types.append('canonical')
-                        else:
-                            seq_types.append('alternative')
-            else: # Assume one single sequence with id UNIPAC-1.
-                isoforms.append('%s-1' % uniprot_ac)
-                seq_types.append('canonical')
-    
-            # Get the length of each isoform.
-            lengths = []
-            for isoform in isoforms:
+        if not first:
+            yield entry
+        first = False
+
+
+def merge_join(entries, groups):
+    """
+    Walk tsv entries and fasta groups, both sorted by UniProt AC, in 
+    lockstep. Yield each entry with the isoform lengths of its AC.
+    Raise UnsortedInputError if tsv entries are not sorted.
+    """
+    group_ac, group = next(groups, (None, {}))
+    previous_ac = None
+    for entry in entries:
+        uniprot_ac = entry[0]
+        if previous_ac is not None and uniprot_ac <= previous_ac:
+            raise UnsortedInputError('Tsv entries are not sorted.')
+        previous_ac = uniprot_ac
+
+        while group_ac is not None and group_ac < uniprot_ac:
+            group_ac, group = next(groups, (None, {}))
+        if group_ac == uniprot_ac:
+            yield entry, group
+        else:
+            yield entry, {}
+
+
+def sort_on_disk(lines, tmpdir, chunk_size=1000000):
+    """
+    Sort text lines with bounded memory. Sorted chunks of 'chunk_size' 
+    lines are written to files in 'tmpdir' and merged with heapq.merge.
+    """
+    chunk_files = []
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            chunk_files.append(write_chunk(sorted(chunk), tmpdir, 
+                                           len(chunk_files)))
+            chunk = []
+    chunk_files.append(write_chunk(sorted(chunk), tmpdir, len(chunk_files)))
+
+    chunk_ins = [open(chunk_file) for chunk_file in chunk_files]
+    for line in heapq.merge(*chunk_ins):
+        yield line
+    for chunk_in in chunk_ins:
+        chunk_in.close()
+
+
+def write_chunk(chunk, tmpdir, i):
+    """ Write a sorted chunk of lines to a temporary file. """
+    chunk_file = '%s/chunk-%i.txt' % (tmpdir, i)
+    with open(chunk_file, 'w') as chunk_out:
+        chunk_out.writelines(chunk)
+    return chunk_file
+
+
+def isoform_length(isoform, isoform_lengths):
+    """
+    Find the length of an isoform. Isoform UNIPAC-1 is often
+    found as UNIPAC in the fasta file. Return None if not found.
+    """
+    try:
+        return isoform_lengths[isoform]
+    except KeyError:
+        canon = isoform.split('-')[0]
+        return isoform_lengths.get(canon)
+
+
+def mapping_record(entry, isoform_lengths, strict=True):
+    """ 
+    Build the xml record of a tsv entry, as a list of string pieces. 
+    If an isoform has no length, raise IprUpdaterError if 'strict' is 
+    True, else write length 0 (reported later by verify_outputs).
+    """
+    uniprot_ac = entry[0]
+    hgnc_symbol = entry[1]
+    hgnc_synonyms = entry[2]
+    hgnc_id = entry[3][:-1]
+    alt_prods = entry[4]
+
+    synonyms = hgnc_synonyms.split()
+    
+    # Process the "ALTERNATIVE PRODUCTS" part of entry.
+    isoform_info = alt_prods.split(';')
+    isoforms = []
+    seq_types = []
+    if len(isoform_info) > 1:
+        for field in isoform_info:
+            if 'IsoId' in field:
+                equal_sign = field.index('=')
+                # Sometimes, there are other ids for a same isoform.
+                # I just take the first it these cases.
                 try:
-                    l = isoform_lengths[isoform]
+                    coma = field.index(',')
+                    isoform_id = field[equal_sign+1:coma]
                 except:
-                    dash = isoform.index('-')
-                    canon = isoform[:dash]
-                    l = isoform_lengths[canon]
-                lengths.append(l)
-    
-            # Write to file in xml style.
-            outfile.write('<entry uniprot_ac="%s" hgnc_symbol="%s" hgnc_id="%s">\n' 
-                          % (uniprot_ac, hgnc_symbol, hgnc_id) )
-            for syn in synonyms:
-                outfile.write('  <synonym>%s</synonym>\n' % syn)
-            for i in range(len(isoforms)):
-                outfile.write('  <isoform>\n')
-                outfile.write('    <id>%s</id>\n' % isoforms[i])
-                outfile.write('    <length>%s</length>\n' % lengths[i])
-                outfile.write('    <type>%s</type>\n' % seq_types[i])
-                outfile.write('  </isoform>\n')
-            outfile.write('</entry>\n')
+                    isoform_id = field[equal_sign+1:]
+                isoforms.append(isoform_id)
+            if 'Sequence' in field:
+                equal_sign = field.index('=')
+                seq_string = field[equal_sign+1:]
+                if seq_string == 'Displayed':
+                    seq_types.append('canonical')
+                else:
+                    seq_types.append('alternative')
+    else: # Assume one single sequence with id UNIPAC-1.
+        isoforms.append('%s-1' % uniprot_ac)
+        seq_types.append('canonical')
+
+    # Get the length of each isoform.
+    lengths = []
+    for isoform in isoforms:
+        l = isoform_length(isoform, isoform_lengths)
+        if l is None:
+            if strict:
+                raise IprUpdaterError('Length of isoform %s not found.' 
+                                      % isoform)
+            print('Length of isoform %s not found.' % isoform)
+            l = 0
+        lengths.append(l)
+
+    # Write to file in xml style.
+    record = ['<entry uniprot_ac="', uniprot_ac,
+              '" hgnc_symbol="', xml_escape(hgnc_symbol),
+              '" hgnc_id="', xml_escape(hgnc_id), '">\n']
+    for syn in synonyms:
+        record += ('  <synonym>', xml_escape(syn), '</synonym>\n')
+    for i in range(len(isoforms)):
+        record += ('  <isoform>\n'
+                   '    <id>', isoforms[i], '</id>\n'
+                   '    <length>', str(lengths[i]), '</length>\n'
+                   '    <type>', seq_types[i], '</type>\n'
+                   '  </isoform>\n')
+    record.append('</entry>\n')
+    return record
+
+
+def update_mapping(version, dldir, wrtdir, merge=False, codec=None):
+    """
+    Write an xml file that contains the UniProt id, HGNC symbol, HGNC id, 
+    HGNC synonyms and isoforms for each reviewed human proteome UniProt entry.
+
+    By default, the length of every isoform is kept in a dictionary.
+    If 'merge' is True, the fasta and tsv files, both requested sorted by 
+    UniProt AC, are instead walked in lockstep with constant memory. 
+    If they turn out not to be sorted, they are first sorted on disk.
+    In that mode, a missing isoform length may only reveal unsorted input,
+    so it is written as 0 instead of stopping the update.
+    The output is compressed with 'codec' (see get_codec).
+    """
+    date = check_dates(version, dldir)
+    codec = get_codec(codec)
+
+    # Input files.
+    tsv_path = '%s/uniprot-hproteome-%i-%s.tsv.gz' % (dldir, version, date)
+    fasta_path = '%s/uniprot-hproteome-%i-%s.fasta.gz' % (dldir, version, date)
     
-        first = False
+    # Output file
+    out_path = '%s/refs-tmp_mapping-%i.xml%s' % (wrtdir, version, codec.suffix)
+
+    # Running options message.
+    print('Extracting information from %s/' % dldir)
+    print('uniprot-hproteome-%i-%s.tsv.gz' % (version, date) )
+    print('uniprot-hproteome-%i-%s.fasta.gz' % (version, date) )
     
-    outfile.write('</mapping>\n')
-    outfile.close()
+    if not merge:
+        with gzip.open(fasta_path, 'rt') as fastafile:
+            isoform_lengths = dict(fasta_lengths(fastafile))
+        with gzip.open(tsv_path, 'rt') as tsvfile, \
+             XmlWriter(out_path, codec=codec) as outfile:
+            outfile.write('<mapping>\n')
+            for entry in tsv_entries(tsvfile):
+                outfile.write_record(mapping_record(entry, isoform_lengths))
+            outfile.write('</mapping>\n')
+    else:
+        print(' -- Merging sorted fasta and tsv files.')
+        try:
+            with gzip.open(fasta_path, 'rt') as fastafile, \
+                 gzip.open(tsv_path, 'rt') as tsvfile, \
+                 XmlWriter(out_path, codec=codec) as outfile:
+                groups = fasta_groups(fasta_lengths(fastafile))
+                outfile.write('<mapping>\n')
+                for entry, group in merge_join(tsv_entries(tsvfile), groups):
+                    outfile.write_record(mapping_record(entry, group,
+                                                        strict=False))
+                outfile.write('</mapping>\n')
+        except UnsortedInputError as error:
+            print(' -- %s Sorting fasta and tsv files on disk.' % error)
+            with gzip.open(fasta_path, 'rt') as fastafile, \
+                 gzip.open(tsv_path, 'rt') as tsvfile, \
+                 tempfile.TemporaryDirectory(dir=wrtdir) as tmpdir, \
+                 XmlWriter(out_path, codec=codec) as outfile:
+                os.makedirs('%s/fasta' % tmpdir)
+                os.makedirs('%s/tsv' % tmpdir)
+                # Lines start with the AC followed by a tab, which sorts
+                # before any other character, so lines are sorted by AC.
+                fasta_lines = sort_on_disk(
+                    ('%s\t%s\t%i\n' % (isoform_id.split('-')[0], 
+                                        isoform_id, l)
+                     for isoform_id, l in fasta_lengths(fastafile)),
+                    '%s/fasta' % tmpdir)
+                tsv_lines = sort_on_disk(
+                    ('\t'.join(entry) + '\n' 
+                     for entry in tsv_entries(tsvfile)),
+                    '%s/tsv' % tmpdir)
+                lengths = ((line.split('\t')[1], int(line.split('\t')[2]))
+                           for line in fasta_lines)
+                entries = (line[:-1].split('\t') for line in tsv_lines)
+                outfile.write('<mapping>\n')
+                for entry, group in merge_join(entries, fasta_groups(lengths)):
+                    outfile.write_record(mapping_record(entry, group,
+                                                        strict=False))
+                outfile.write('</mapping>\n')
 
     # Copy final output file if everything went well.
-    shutil.copyfile('%s/refs-tmp_mapping-%i.xml.gz' % (wrtdir, version), 
-                    '%s/refs_mapping-%i.xml.gz' % (wrtdir, version) )
-    os.remove('%s/refs-tmp_mapping-%i.xml.gz' % (wrtdir, version) )
+    filename = 'refs_mapping-%i.xml%s' % (version, codec.suffix)
+    shutil.copyfile(out_path, '%s/%s' % (wrtdir, filename) )
+    os.remove(out_path)
+    save_record_count(version, wrtdir, filename, outfile.records, codec)
 # ===========================================================================
 
 
@@ -324,32 +886,38 @@ def update_mapping(version, dldir, wrtdir):
 #
 # Short names are used as official name for domains
 # and parents are used to merge domains that are banched.
+# The full hierarchy (all parents, ancestors, depth and root of each entry)
+# is also written, so that it does not need to be walked at query time.
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 def update_shortname(version, dldir, wrtdir, 
-                     human_only = False, exclude_family = False):
+                     human_only = False, exclude_family = False, codec=None,
+                     hierarchy_codec=None):
     """
     Write an xml file that contains the id, short name, name, 
-    parent and type of each InterPro entry.
+    parent and type of each InterPro entry, and the hierarchy file.
+    Both are compressed with 'codec' (see get_codec), unless 
+    'hierarchy_codec' is given for the hierarchy file.
     """
+    codec = get_codec(codec)
     # Input files.
-    infile = '%s/interpro-%i.xml.gz' % (dldir, version)
-    interpro_in = gzip.open(infile,'r').read()
+    infile = input_path('%s/interpro-%i.xml.gz' % (dldir, version))
+    interpro_in = open_input(infile)
     
     # Output files.
     if human_only and exclude_family:
-        filename = 'ipr-tmp_shortnames-nofam-human-%i.xml.gz' % version
+        filename = 'ipr-tmp_shortnames-nofam-human-%i.xml%s' % (version, codec.suffix)
     if human_only and not exclude_family:
-        filename = 'ipr-tmp_shortnames-human-%i.xml.gz' % version
+        filename = 'ipr-tmp_shortnames-human-%i.xml%s' % (version, codec.suffix)
     if not human_only and exclude_family:
-        filename = 'ipr-tmp_shortnames-nofam-%i.xml.gz' % version
+        filename = 'ipr-tmp_shortnames-nofam-%i.xml%s' % (version, codec.suffix)
     if not human_only and not exclude_family:
-        filename = 'ipr-tmp_shortnames-%i.xml.gz' % version
-    short_out = gzip.open('%s/%s' % (wrtdir, filename), 'wt')
+        filename = 'ipr-tmp_shortnames-%i.xml%s' % (version, codec.suffix)
+    short_out = XmlWriter('%s/%s' % (wrtdir, filename), codec=codec)
         
     # Running options message.
     print('Extracting information from %s/' % dldir)
-    print('interpro-%i.xml.gz' % version)
+    print(os.path.basename(infile))
     if human_only:
         print(' -- Keeping only features found in "Human".')
     if exclude_family:
@@ -358,12 +926,17 @@ def update_shortname(version, dldir, wrtdir,
         print(' -- Keeping all entries.')
     
     
-    interpro_root = etree.fromstring(interpro_in)
-    
     short_out.write('<interprodb>\n')
+
+    # All parents of every entry, used to write the hierarchy file.
+    all_parents = {}
     
-    entries = interpro_root.findall("interpro")
-    for entry in entries:
+    # Entries are streamed and cleared once read.
+    for event, entry in etree.iterparse(interpro_in, tag='interpro'):
+
+        all_parents[entry.get('id')] = [
+            rel_ref.get('ipr_ref') 
+            for rel_ref in entry.findall('parent_list/rel_ref')]
     
         # Find if entry is found in Human.
         in_human = False
@@ -393,24 +966,128 @@ def update_shortname(version, dldir, wrtdir,
                 except:
                     parent = None
     
-                # Escape special characters that are sometimes found in InterPro domain names (",&)
-                if '"' in name:
-                    name = re.sub(r'"','&quot;',name)
-                if '&' in name:
-                    name = re.sub(r'&','&amp;',name)
-    
-                short_out.write('<interpro id="%s" short_name="%s" name="%s" parent="%s" type="%s"/>\n' 
-                                % (ipr, shortname, name, parent, feature_type) )
+                # Escape special characters that are sometimes found 
+                # in InterPro domain names (", &, <, >, ').
+                short_out.write_record(
+                    ['<interpro id="', ipr,
+                     '" short_name="', xml_escape(shortname),
+                     '" name="', xml_escape(name),
+                     '" parent="', str(parent),
+                     '" type="', feature_type, '"/>\n'])
+
+        entry.clear()
+        while entry.getprevious() is not None:
+            del entry.getparent()[0]
     
 
     short_out.write('</interprodb>\n')
     short_out.close()
+    interpro_in.close()
+
+    write_hierarchy(all_parents, version, wrtdir, 
+                    codec=hierarchy_codec or codec)
 
     # Copy final output file if everything went well.
     new_filename = '%s%s' % (filename[:3], filename[7:])
     shutil.copyfile('%s/%s' % (wrtdir, filename), 
                     '%s/%s' % (wrtdir, new_filename))
     os.remove('%s/%s' % (wrtdir, filename))
+    save_record_count(version, wrtdir, new_filename, short_out.records, 
+                      codec)
+
+
+def hierarchy_closure(all_parents, numbering=True):
+    """
+    Compute the ancestors, depth and root of each InterPro entry from 
+    the dictionary of the parents of each entry. Ancestors are ordered
+    from nearest to farthest (a parent comes before its own parents).
+
+    If 'numbering' is True, entries are also numbered by a depth-first 
+    (Euler) tour of the tree made by the first parent of each entry.
+    Entry A is then an ancestor of entry B in that tree if and only if
+    left[A] <= left[B] and right[B] <= right[A]. The numbering covers 
+    first parents only, the other ancestors are only found in 'ancestors'.
+    An entry whose first parent is not in 'all_parents' starts its own 
+    tree. Entries on a cycle of first parents are not numbered.
+    """
+    closure = {}
+    for ipr in all_parents:
+        # Walk up the hierarchy, nearest ancestors first.
+        ancestors = []
+        pending = list(all_parents[ipr])
+        while pending:
+            parent = pending.pop(0)
+            if parent in ancestors or parent == ipr:
+                continue
+            ancestors.append(parent)
+            pending += all_parents.get(parent, [])
+
+        # Depth and root follow the chain of first parents, up to the 
+        # last one known, as the numbering below.
+        depth = 0
+        root = ipr
+        while (all_parents.get(root) and all_parents[root][0] in all_parents
+               and depth <= len(all_parents)):
+            root = all_parents[root][0]
+            depth += 1
+        closure[ipr] = {'parents': all_parents[ipr], 'ancestors': ancestors,
+                        'depth': depth, 'root': root}
+
+    if numbering:
+        children = {}
+        for ipr in sorted(all_parents):
+            if all_parents[ipr]:
+                children.setdefault(all_parents[ipr][0], []).append(ipr)
+        count = 0
+        for root in sorted(all_parents):
+            if all_parents[root] and all_parents[root][0] in all_parents:
+                continue
+            # Iterative depth-first tour, to avoid recursion limits.
+            stack = [(root, False)]
+            while stack:
+                ipr, leaving = stack.pop()
+                count += 1
+                if leaving:
+                    closure[ipr]['right'] = count
+                    continue
+                closure[ipr]['left'] = count
+                stack.append((ipr, True))
+                for child in reversed(children.get(ipr, [])):
+                    stack.append((child, False))
+
+    return closure
+
+
+def write_hierarchy(all_parents, version, wrtdir, numbering=True, 
+                    codec=None):
+    """
+    Write an xml file that contains the parents, ancestors, depth and 
+    root of each InterPro entry, and optionally its Euler tour interval.
+    """
+    codec = get_codec(codec)
+    filename = 'ipr_hierarchy-%i.xml%s' % (version, codec.suffix)
+    closure = hierarchy_closure(all_parents, numbering)
+
+    hierarchy_out = XmlWriter('%s/tmp-%s' % (wrtdir, filename), codec=codec)
+    hierarchy_out.write('<interprohierarchy>\n')
+    for ipr in sorted(closure):
+        info = closure[ipr]
+        record = ['<interpro id="', ipr, 
+                  '" parents="', ' '.join(info['parents']),
+                  '" ancestors="', ' '.join(info['ancestors']),
+                  '" depth="', str(info['depth']), 
+                  '" root="', info['root']]
+        if 'left' in info:
+            record += ('" left="', str(info['left']), 
+                       '" right="', str(info['right']))
+        record.append('"/>\n')
+        hierarchy_out.write_record(record)
+    hierarchy_out.write('</interprohierarchy>\n')
+    hierarchy_out.close()
+
+    os.replace('%s/tmp-%s' % (wrtdir, filename), '%s/%s' % (wrtdir, filename))
+    save_record_count(version, wrtdir, filename, hierarchy_out.records, 
+                      codec)
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
@@ -423,71 +1100,122 @@ def update_shortname(version, dldir, wrtdir,
 # entries (the number of protein sequences in TrEMBL).
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def update_match(version, dldir, wrtdir):
+class MatchWriter:
     """
-    Write an xml file that contains the InterPro signatures of each 
-    UniProt reviewed human proteome entry.
+    Write the entries found by update_match to 
+    ipr_reviewed_human_match-<version>-copy.xml.gz.
+
+    If 'shards' is more than 1, the sorted list of ACs is split in that
+    many ranges of consecutive ACs, and each entry is also written to the
+    file of its range, ipr_reviewed_human_match-<version>-shardNN.xml.gz.
+    The range, number of entries and file name of each shard are written
+    to ipr_reviewed_human_match-<version>-shards.txt, so that downstream 
+    loaders can read shards in parallel or fetch only the shard they need.
+    All files are compressed with 'codec' (see get_codec).
     """
-    date = check_dates(version, dldir)
 
-    # Input files.
-    rev_human_proteome = gzip.open('%s/uniprot-hproteome-%i-%s.fasta.gz' 
-                                   % (dldir, version, date),'r')
-    complete_match_in = gzip.open('%s/match_complete-%i.xml.gz'
-                                  % (dldir, version),'r')
-    
-    # Output files.
-    matchrun_out = open('reviewed_human_match_run.out','w')
-    proteome_list = open('%s/uniprot-entries-%i-%s.txt' 
-                         % (wrtdir, version, date),'w')
-    swiss_match_out = gzip.open('%s/ipr_reviewed_human_match-%i-copy.xml.gz'
-                                % (wrtdir, version),'wt')
-    
-    # Running options message.
-    print('Extracting information from %s/' % dldir)
-    print('match_complete-%i.xml.gz' % version)
-    print('uniprot-hproteome-%i-%s.fasta.gz' % (version, date) )
-    print(' -- This can take several hours. Need to parse ~5 billion lines.')
+    def __init__(self, version, wrtdir, sorted_protlist, shards=1, 
+                 codec=None):
+        self.version = version
+        self.wrtdir = wrtdir
+        self.codec = get_codec(codec)
+        self.main_out = XmlWriter('%s/ipr_reviewed_human_match-%i-copy.xml%s'
+                                  % (wrtdir, version, self.codec.suffix),
+                                  codec=self.codec)
+        # Element Tree expects xml files to have a single root tag.
+        self.main_out.write('<interpromatch>\n')
 
-    # Extract UniProt ACs from uniprot-human-proteome.fasta.gz.
-    # ////////////
-    n = 0
-    reviewed_protlist = []
-    for line in rev_human_proteome:
-        stringline = line.decode("utf-8")
-        if '>sp' in stringline:
-            pipe = stringline.index('|')+1
-            unpipe = stringline[pipe:].index('|') + pipe
-            uniprot_ac = stringline[pipe:unpipe]
-            reviewed_protlist.append(uniprot_ac)
-    
-    # Sort ACs so that they are in the same order as in match_complete.xml.gz.
-    sorted_protlist = sorted(reviewed_protlist)
-    
-    # Print sorted list of ACs to file.
-    for uniprot_ac in sorted_protlist:
-            n += 1
-            proteome_list.write('%5i %s\n' % (n, uniprot_ac) )
-    proteome_list.close()
-    print('Searching for %i reviewed entries in match_complete.xml.gz' % n)
-    matchrun_out.write('Searching for %i reviewed entries in ' 
-                       'match_complete.xml.gz\n' % n )
-    # ////////////
-    
-    
+        # First and last AC of each shard.
+        self.ranges = []
+        if shards > 1:
+            # An entry and its isoforms (AC-2, AC-3...) follow each other
+            # in the sorted list and always go to the same shard.
+            groups = []
+            for uniprot_ac in sorted_protlist:
+                if groups and uniprot_ac.split('-')[0] == groups[-1][0]:
+                    groups[-1][2] = uniprot_ac
+                else:
+                    groups.append([uniprot_ac.split('-')[0], uniprot_ac, 
+                                   uniprot_ac])
+            # The first 'extra' shards get one more entry than the others.
+            size, extra = divmod(len(groups), shards)
+            start = 0
+            for i in range(min(shards, len(groups))):
+                end = start + size + (1 if i < extra else 0)
+                self.ranges.append((groups[start][1], groups[end-1][2]))
+                start = end
+        self.firsts = [first for first, last in self.ranges]
+        self.records = 0
+        self.counts = [0] * len(self.ranges)
+        self.shard_outs = []
+        for i in range(len(self.ranges)):
+            shard_out = XmlWriter('%s/tmp-%s' % (wrtdir, self.shard_name(i)),
+                                  codec=self.codec)
+            shard_out.write('<interpromatch>\n')
+            self.shard_outs.append(shard_out)
+        self.current = None
+
+    def shard_name(self, i):
+        return 'ipr_reviewed_human_match-%i-shard%02d.xml%s' % (
+            self.version, i, self.codec.suffix)
+
+    def start_entry(self, uniprot_ac):
+        """ Count the entry about to be written and select its shard. """
+        self.records += 1
+        if self.shard_outs:
+            i = max(bisect.bisect_right(self.firsts, uniprot_ac) - 1, 0)
+            self.counts[i] += 1
+            self.current = self.shard_outs[i]
+
+    def write(self, text):
+        self.main_out.write(text)
+        if self.current is not None:
+            self.current.write(text)
+
+    def close(self):
+        self.main_out.write('</interpromatch>\n')
+        self.main_out.close()
+        if not self.shard_outs:
+            return
+
+        for i, shard_out in enumerate(self.shard_outs):
+            shard_out.write('</interpromatch>\n')
+            shard_out.close()
+            os.replace('%s/tmp-%s' % (self.wrtdir, self.shard_name(i)),
+                       '%s/%s' % (self.wrtdir, self.shard_name(i)))
+            save_record_count(self.version, self.wrtdir, self.shard_name(i),
+                              self.counts[i], self.codec)
+
+        # The shard directory is written last, once all shards are complete.
+        directory = '%s/ipr_reviewed_human_match-%i-shards.txt' % (
+            self.wrtdir, self.version)
+        with open('%s.tmp' % directory, 'w') as directory_out:
+            directory_out.write('# shard\tfirst_ac\tlast_ac\tentries\tfile\n')
+            for i, (first, last) in enumerate(self.ranges):
+                directory_out.write('%i\t%s\t%s\t%i\t%s\n' 
+                                    % (i, first, last, self.counts[i],
+                                       self.shard_name(i)))
+        os.replace('%s.tmp' % directory, directory)
+
+
+def scan_match(complete_match_in, sorted_protlist, matchrun_out, 
+               stop_ac=None):
+    """
+    Loop over the lines of match_complete.xml.gz and yield the UniProt AC
+    and text of each entry whose AC is in 'sorted_protlist'.
+    If 'stop_ac' is given, stop at the first entry with AC >= 'stop_ac'.
+    """
     # Useful variables.
     n = 0
     pos = 0
     sublist_ind = 0
     sublist_size = 4
     writeit = False
+    entry = []
     starttime = time.time()
     
     sublist = sorted_protlist[sublist_ind:sublist_ind + sublist_size]
     
-    # Element Tree expects xml files to have a single root tag.
-    swiss_match_out.write('<interpromatch>\n')
-    
     # Loop over file match_complete.xml.gz.
     for line in complete_match_in:
         stringline = line.decode("utf-8") 
@@ -497,6 +1225,9 @@ def update_match(version, dldir, wrtdir):
             quote = stringline.index('"')+1
             unquote = stringline[quote:].index('"') + quote
             uniprot_ac = stringline[quote:unquote]
+
+            if stop_ac is not None and uniprot_ac >= stop_ac:
+                break
     
             # Check if AC is in the UniProt reviewed human genome.
             # If so, start writing entry to output file.
@@ -506,6 +1237,7 @@ def update_match(version, dldir, wrtdir):
                 print(acfound)
                 matchrun_out.write('%s\n' % (acfound) )
                 writeit = True
+                found_ac = uniprot_ac
     
                 # Check if AC was the first element of sublist.
                 # Otherwise, that means a reviewed entry is missing or 
@@ -525,10 +1257,13 @@ def update_match(version, dldir, wrtdir):
                 sublist = sorted_protlist[sublist_ind:sublist_ind + sublist_size]
     
         if writeit:
-            swiss_match_out.write('%s' %(stringline) )
+            entry.append(stringline)
     
         # Entry stops with the line containing string '</protein>'.
         if '</protein>' in stringline:
+            if writeit:
+                yield found_ac, ''.join(entry)
+                entry = []
             writeit = False
     
         # Print progress.
@@ -541,13 +1276,311 @@ def update_match(version, dldir, wrtdir):
             )
             print(progress)
             matchrun_out.write('%s\n' %(progress) )
+
+
+def scan_match_mmap(match_map, sorted_protlist, matchrun_out, offset=0,
+                    stop_ac=None):
+    """
+    Same as scan_match, for an uncompressed match_complete.xml mapped in 
+    memory. <protein> tags are searched with mmap.find from 'offset' and 
+    entries are yielded as memoryview slices of the map, so that no line
+    is copied into a Python string.
+    """
+    view = memoryview(match_map)
+    targets = [uniprot_ac.encode('utf-8') for uniprot_ac in sorted_protlist]
+    if stop_ac is not None:
+        stop_ac = stop_ac.encode('utf-8')
+
+    # Useful variables.
+    n = 0
+    count = 0
+    sublist_ind = 0
+    sublist_size = 4
+    starttime = time.time()
+
+    sublist = targets[sublist_ind:sublist_ind + sublist_size]
+
+    pos = match_map.find(b'<protein id="', offset)
+    while pos != -1:
+        quote = pos + 13
+        unquote = match_map.find(b'"', quote)
+        uniprot_ac = match_map[quote:unquote]
+
+        if stop_ac is not None and uniprot_ac >= stop_ac:
+            break
+
+        next_pos = unquote
+        if uniprot_ac in sublist:
+            n += 1
+            sublist_str = [ac.decode('utf-8') for ac in sublist]
+            acfound = ('Found reviewed UniProt Accession %i: %s %s'
+                       % (n, uniprot_ac.decode('utf-8'), sublist_str))
+            print(acfound)
+            matchrun_out.write('%s\n' % (acfound) )
+
+            # Check if AC was the first element of sublist.
+            ac_index = sublist.index(uniprot_ac)
+            if ac_index != 0:
+                skipped = ''.join(sublist_str[:ac_index])
+                print('AC %s were skipped. %s' % (skipped, sublist_str))
+                matchrun_out.write('AC %swere skipped. %s\n' 
+                                   % (skipped, sublist_str))
+
+            # Update sublist.
+            sublist_ind += 1 + ac_index
+            sublist = targets[sublist_ind:sublist_ind + sublist_size]
+
+            # Entry spans from the start of its first line to the end of 
+            # the line containing string '</protein>'.
+            start = match_map.rfind(b'\n', 0, pos) + 1
+            end = match_map.find(b'</protein>', unquote)
+            if end == -1:
+                raise IprUpdaterError('Entry %s is not terminated.' 
+                                      % uniprot_ac.decode('utf-8'))
+            end = match_map.find(b'\n', end) + 1 or len(match_map)
+            entry = view[start:end]
+            yield uniprot_ac.decode('utf-8'), entry
+            entry.release()
+            next_pos = end
+
+        # Print progress.
+        count += 1
+        if count%10000000 == 0:
+            t = time.time() - starttime
+            progress = ('%iM entries parsed in %is, %i AC found. '
+                        'Searching for %s' 
+                        % (count/1000000, t, n, 
+                           b' '.join(sublist).decode('utf-8') )
+            )
+            print(progress)
+            matchrun_out.write('%s\n' %(progress) )
+
+        pos = match_map.find(b'<protein id="', next_pos)
+    view.release()
+
+
+def scan_input(match_path, sorted_protlist, matchrun_out, offset=0, 
+               stop_ac=None):
+    """
+    Scan match_complete from 'offset', with scan_match for a gzip file or 
+    with scan_match_mmap for an uncompressed file.
+    """
+    with open(match_path, 'rb') as match_file:
+        if match_path.endswith('.gz'):
+            match_file.seek(offset)
+            complete_match_in = gzip.GzipFile(fileobj=match_file, mode='r')
+            yield from scan_match(complete_match_in, sorted_protlist, 
+                                  matchrun_out, stop_ac)
+        else:
+            with mmap.mmap(match_file.fileno(), 0, 
+                           access=mmap.ACCESS_READ) as match_map:
+                yield from scan_match_mmap(match_map, sorted_protlist, 
+                                           matchrun_out, offset, stop_ac)
+
+
+def match_regions(match_path, parts, window=1048576):
+    """
+    Split match_complete.xml.gz in up to 'parts' regions that can be 
+    decompressed independently. Return the offset and first UniProt AC 
+    of each region. The first region starts at offset 0 with AC ''.
+
+    A deflate stream can only be entered at the start of a gzip member, 
+    so the regions start at gzip members found near evenly spaced offsets.
+    This requires a file written in several members (BGZF, pigz -i, 
+    concatenated gzip files). A file written as a single member gives a 
+    single region. An uncompressed file can be entered anywhere, so its 
+    regions start at the <protein> lines following evenly spaced offsets.
+    """
+    size = os.path.getsize(match_path)
+    regions = [(0, '')]
+
+    if not match_path.endswith('.gz'):
+        with open(match_path, 'rb') as match_file, \
+             mmap.mmap(match_file.fileno(), 0, 
+                       access=mmap.ACCESS_READ) as match_map:
+            for k in range(1, parts):
+                pos = match_map.find(b'\n<protein id="', size * k // parts)
+                if pos == -1:
+                    continue
+                quote = pos + 14
+                unquote = match_map.find(b'"', quote)
+                first_ac = match_map[quote:unquote].decode('utf-8')
+                if first_ac > regions[-1][1]:
+                    regions.append((pos + 1, first_ac))
+        return regions
+
+    with open(match_path, 'rb') as match_in:
+        for k in range(1, parts):
+            match_in.seek(size * k // parts)
+            offset = member_offset(match_in, window)
+            if offset is None or offset <= regions[-1][0]:
+                continue
+
+            # Resynchronize on the first <protein> of the member.
+            match_in.seek(offset)
+            first_ac = None
+            for line in gzip.GzipFile(fileobj=match_in, mode='r'):
+                if b'<protein id=' in line:
+                    quote = line.index(b'"')+1
+                    unquote = line.index(b'"', quote)
+                    first_ac = line[quote:unquote].decode('utf-8')
+                    break
+            if first_ac is not None and first_ac > regions[-1][1]:
+                regions.append((offset, first_ac))
+    return regions
+
+
+def member_offset(match_in, window):
+    """
+    Find the offset of the next gzip member in the 'window' bytes 
+    following the current position of 'match_in'.
+    """
+    position = match_in.tell()
+    data = match_in.read(window + 65536)
+    i = data.find(b'\x1f\x8b\x08')
+    while -1 < i < window:
+        # Check that a member really starts there by inflating its start.
+        try:
+            inflated = zlib.decompressobj(31).decompress(data[i:i+65536])
+            if inflated and b'\x00' not in inflated:
+                return position + i
+        except zlib.error:
+            pass
+        i = data.find(b'\x1f\x8b\x08', i + 1)
+    return None
+
+
+def scan_match_region(match_path, offset, sorted_protlist, stop_ac, 
+                      part_path):
+    """
+    Scan one region of match_complete in a worker process.
+    Entries are written to <part_path>.xml.gz and messages 
+    to <part_path>.out.
+    """
+    with open('%s.out' % part_path, 'w') as matchrun_out:
+        part_out = XmlWriter('%s.xml.gz' % part_path)
+        for uniprot_ac, entry in scan_input(match_path, sorted_protlist,
+                                            matchrun_out, offset, stop_ac):
+            part_out.write(entry)
+        part_out.close()
+
+
+def update_match(version, dldir, wrtdir, shards=1, workers=1, codec=None):
+    """
+    Write an xml file that contains the InterPro signatures of each 
+    UniProt reviewed human proteome entry.
+    If 'shards' is more than 1, the entries are also written to that
+    many files by range of accessions (see MatchWriter).
+    If 'workers' is more than 1, regions of match_complete.xml.gz are
+    scanned in parallel by that many processes (see match_regions).
+    The output is compressed with 'codec' (see get_codec).
+    """
+    date = check_dates(version, dldir)
+    codec = get_codec(codec)
+
+    # Input files.
+    rev_human_proteome = gzip.open('%s/uniprot-hproteome-%i-%s.fasta.gz' 
+                                   % (dldir, version, date),'r')
+    match_path = input_path('%s/match_complete-%i.xml.gz' % (dldir, version))
+    
+    # Output files.
+    matchrun_out = open('reviewed_human_match_run.out','w')
+    proteome_list = open('%s/uniprot-entries-%i-%s.txt' 
+                         % (wrtdir, version, date),'w')
+    
+    # Running options message.
+    print('Extracting information from %s/' % dldir)
+    print(os.path.basename(match_path))
+    print('uniprot-hproteome-%i-%s.fasta.gz' % (version, date) )
+    print(' -- This can take several hours. Need to parse ~5 billion lines.')
+
+    # Extract UniProt ACs from uniprot-human-proteome.fasta.gz.
+    # ////////////
+    n = 0
+    reviewed_protlist = []
+    for line in rev_human_proteome:
+        stringline = line.decode("utf-8")
+        if '>sp' in stringline:
+            pipe = stringline.index('|')+1
+            unpipe = stringline[pipe:].index('|') + pipe
+            uniprot_ac = stringline[pipe:unpipe]
+            reviewed_protlist.append(uniprot_ac)
+    
+    # Sort ACs so that they are in the same order as in match_complete.xml.gz.
+    sorted_protlist = sorted(reviewed_protlist)
+    swiss_match_out = MatchWriter(version, wrtdir, sorted_protlist, shards, 
+                                  codec)
+    
+    # Print sorted list of ACs to file.
+    for uniprot_ac in sorted_protlist:
+            n += 1
+            proteome_list.write('%5i %s\n' % (n, uniprot_ac) )
+    proteome_list.close()
+    print('Searching for %i reviewed entries in match_complete.xml.gz' % n)
+    matchrun_out.write('Searching for %i reviewed entries in ' 
+                       'match_complete.xml.gz\n' % n )
+    # ////////////
+    
+    
+    if workers > 1:
+        regions = match_regions(match_path, workers)
+        if len(regions) == 1:
+            print(' -- %s cannot be split for parallel scanning (it needs '
+                  'several gzip members, see --workers), scanning it in '
+                  'one process.' % os.path.basename(match_path))
+    else:
+        regions = [(0, '')]
+
+    if len(regions) == 1:
+        # Scan the whole file in this process.
+        for uniprot_ac, entry in scan_input(match_path, sorted_protlist,
+                                            matchrun_out):
+            swiss_match_out.start_entry(uniprot_ac)
+            swiss_match_out.write(entry)
+    else:
+        print(' -- Scanning %i regions of %s in parallel.' 
+              % (len(regions), os.path.basename(match_path)))
+        tasks = []
+        for i, (offset, first_ac) in enumerate(regions):
+            # Each region gets the ACs from its first AC 
+            # up to the first AC of the next region.
+            if i + 1 < len(regions):
+                stop_ac = regions[i+1][1]
+                end = bisect.bisect_left(sorted_protlist, stop_ac)
+            else:
+                stop_ac = None
+                end = len(sorted_protlist)
+            start = bisect.bisect_left(sorted_protlist, first_ac)
+            part_path = '%s/tmp-ipr_reviewed_human_match-%i-part%02d' % (
+                wrtdir, version, i)
+            tasks.append((match_path, offset, sorted_protlist[start:end], 
+                          stop_ac, part_path))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(scan_match_region, *task) 
+                       for task in tasks]
+            # Concatenate the outputs of the regions in order.
+            for future, task in zip(futures, tasks):
+                future.result()
+                part_path = task[4]
+                with open('%s.out' % part_path) as part_log:
+                    shutil.copyfileobj(part_log, matchrun_out)
+                with gzip.open('%s.xml.gz' % part_path, 'r') as part_in:
+                    for uniprot_ac, block in protein_blocks(part_in):
+                        swiss_match_out.start_entry(uniprot_ac)
+                        swiss_match_out.write(block.decode('utf-8'))
+                os.remove('%s.out' % part_path)
+                os.remove('%s.xml.gz' % part_path)
     
-    swiss_match_out.write('</interpromatch>\n')
     swiss_match_out.close()
 
     # Make a copy of the generated file, since it took so long.
-    shutil.copyfile('%s/ipr_reviewed_human_match-%i-copy.xml.gz' % (wrtdir, version), 
-                    '%s/ipr_reviewed_human_match-%i.xml.gz' % (wrtdir, version) )
+    filename = 'ipr_reviewed_human_match-%i.xml%s' % (version, codec.suffix)
+    shutil.copyfile('%s/ipr_reviewed_human_match-%i-copy.xml%s' 
+                    % (wrtdir, version, codec.suffix), 
+                    '%s/%s' % (wrtdir, filename) )
+    save_record_count(version, wrtdir, filename, swiss_match_out.records,
+                      codec)
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 
@@ -558,24 +1591,31 @@ def update_match(version, dldir, wrtdir):
 # ones with no dash (-).
 # ***************************************************************************
 
-def extract_canon(version, wrtdir):
+def extract_canon(version, wrtdir, codec=None):
     """
     Write an xml file that contains the InterPro signatures of each 
     canonical UniProt reviewed human proteome entry.
+    If 'codec' is None, the output uses the codec and level of the 
+    input file (see saved_codec).
     """
     # Input file.
-    rev_human_match_in =  gzip.open('%s/ipr_reviewed_human_match-%i.xml.gz'
-        % (wrtdir, version),'r')
+    in_path = find_artifact(wrtdir, 'ipr_reviewed_human_match-%i.xml' % version)
+    rev_human_match_in = open_compressed(in_path)
+    if codec is None:
+        codec = saved_codec(version, wrtdir, os.path.basename(in_path))
+    codec = get_codec(codec)
     
     # Output file.
-    canon_human_match_out =  gzip.open('%s/ipr_canonical_human_match-%i.xml.gz'
-        % (wrtdir, version),'wt')
+    filename = 'ipr_canonical_human_match-%i.xml%s' % (version, codec.suffix)
+    canon_human_match_out = XmlWriter('%s/%s' % (wrtdir, filename), 
+                                      codec=codec)
 
     # Running options message.
     print('Extracting information from %s/' % wrtdir)
-    print('ipr_reviewed_human_match-%i.xml.gz' % version)
+    print(os.path.basename(in_path))
 
     writeit = False
+    entry = []
 
     # Element Tree expects xml files to have a single root tag.
     canon_human_match_out.write('<interpromatch>\n')
@@ -593,12 +1633,461 @@ def extract_canon(version, wrtdir):
                 writeit = True
 
         if writeit:
-            canon_human_match_out.write('%s' %(stringline) )
+            entry.append(stringline)
 
         # Entry stops with the line containing string '</protein>'.
         if '</protein>' in stringline:
+            if writeit:
+                canon_human_match_out.write_record(entry)
+                entry = []
             writeit = False
 
     canon_human_match_out.write('</interpromatch>\n')
     canon_human_match_out.close()
+    rev_human_match_in.close()
+    save_record_count(version, wrtdir, filename, 
+                      canon_human_match_out.records, codec)
 # ***************************************************************************
+
+
+# 6. Summarize the InterPro domains of each entry of 
+# ipr_reviewed_human_match.xml.gz.
+#
+# The locations of the matches of each entry are grouped by InterPro entry,
+# after collapsing each InterPro entry into its root parent (from the 
+# ipr_hierarchy file), and the overlapping locations are merged. This is 
+# done once per version instead of at each query of the Anatomizer.
+# ===========================================================================
+
+def read_roots(version, wrtdir):
+    """ Read the root of each InterPro entry from ipr_hierarchy. """
+    path = find_artifact(wrtdir, 'ipr_hierarchy-%i.xml' % version)
+    return dict((entry.get('id'), entry.get('root'))
+                for entry in iter_records(path, 'interpro'))
+
+
+def merge_intervals(intervals):
+    """ Merge overlapping (start, end) intervals. """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def update_domain_summary(version, wrtdir, codec=None):
+    """
+    Write an xml file that contains the merged InterPro domain intervals
+    of each UniProt reviewed human proteome entry and isoform.
+    If 'codec' is None, the output uses the codec and level of the 
+    input file (see saved_codec).
+    """
+    # Input files.
+    in_path = find_artifact(wrtdir, 'ipr_reviewed_human_match-%i.xml' % version)
+    rev_human_match_in = open_compressed(in_path)
+    roots = read_roots(version, wrtdir)
+    if codec is None:
+        codec = saved_codec(version, wrtdir, os.path.basename(in_path))
+    codec = get_codec(codec)
+
+    # Output file.
+    filename = 'ipr_domain_summary-%i.xml%s' % (version, codec.suffix)
+    summary_out = XmlWriter('%s/tmp-%s' % (wrtdir, filename), codec=codec)
+
+    # Running options message.
+    print('Extracting information from %s/' % wrtdir)
+    print(os.path.basename(in_path))
+    print('ipr_hierarchy-%i.xml' % version)
+
+    summary_out.write('<domainsummary>\n')
+    for uniprot_ac, block in protein_blocks(rev_human_match_in):
+        protein = etree.fromstring(block)
+
+        intervals = {}
+        for ipr in protein.iterfind('match/ipr'):
+            ipr_id = ipr.get('id')
+            domain = intervals.setdefault(roots.get(ipr_id, ipr_id), [])
+            for lcn in ipr.itersiblings('lcn'):
+                domain.append((int(lcn.get('start')), int(lcn.get('end'))))
+
+        domains = []
+        for ipr_id, locations in intervals.items():
+            for start, end in merge_intervals(locations):
+                domains.append((start, end, ipr_id))
+
+        record = ['<protein id="', uniprot_ac, '" length="', 
+                  protein.get('length'), '">']
+        for start, end, ipr_id in sorted(domains):
+            record += ('<domain ipr="', ipr_id, '" start="', str(start), 
+                       '" end="', str(end), '"/>')
+        record.append('</protein>\n')
+        summary_out.write_record(record)
+    summary_out.write('</domainsummary>\n')
+    summary_out.close()
+    rev_human_match_in.close()
+
+    os.replace('%s/tmp-%s' % (wrtdir, filename), '%s/%s' % (wrtdir, filename))
+    save_record_count(version, wrtdir, filename, summary_out.records, codec)
+# ===========================================================================
+
+
+
+# 7. Write the release-to-release delta of ipr_reviewed_human_match and 
+# the manifest of the custom files of a version.
+#
+# The manifest records the size and checksum of every custom file of a 
+# version, and the number of records counted by the functions that wrote 
+# it. It is put in place only once the files pass verification, then it is 
+# compared by to_ens_perso.py with the manifest found on the remote site, 
+# so that only missing or changed files are sent.
+# The delta contains only the protein entries that were added or changed 
+# since the previous version, plus the ids of the removed entries.
+# ###########################################################################
+
+# Prefixes of the custom files that belong to a release.
+ARTIFACT_PREFIXES = ('refs_mapping-', 'ipr_shortnames-', 'ipr_hierarchy-',
+                     'ipr_reviewed_human_match-', 
+                     'ipr_canonical_human_match-', 'ipr_domain_summary-',
+                     'ipr_match_delta-')
+
+# Tag of the records of each custom file, counted by verify_outputs.
+RECORD_TAGS = {'refs_mapping-': 'entry', 
+               'ipr_shortnames-': 'interpro',
+               'ipr_hierarchy-': 'interpro',
+               'ipr_reviewed_human_match-': 'protein',
+               'ipr_canonical_human_match-': 'protein',
+               'ipr_domain_summary-': 'protein',
+               'ipr_match_delta-': 'protein'}
+
+
+def protein_blocks(infile):
+    """
+    Iterate over the <protein> entries of a match file opened in binary mode.
+    Yield the UniProt AC and the lines of each entry as bytes.
+    """
+    block = None
+    for line in infile:
+        if b'<protein id=' in line:
+            quote = line.index(b'"')+1
+            unquote = line.index(b'"', quote)
+            uniprot_ac = line[quote:unquote].decode('utf-8')
+            block = [line]
+        elif block is not None:
+            block.append(line)
+        if block is not None and b'</protein>' in line:
+            yield uniprot_ac, b''.join(block)
+            block = None
+
+
+def write_match_delta(old_version, new_version, wrtdir, codec=None):
+    """
+    Write an xml file that contains the entries of 
+    ipr_reviewed_human_match that changed between two versions.
+    If 'codec' is None, the output uses the codec and level of the 
+    new version (see saved_codec).
+    """
+    old_in = open_compressed(find_artifact(
+        wrtdir, 'ipr_reviewed_human_match-%i.xml' % old_version))
+    new_path = find_artifact(wrtdir, 
+                             'ipr_reviewed_human_match-%i.xml' % new_version)
+    new_in = open_compressed(new_path)
+    if codec is None:
+        codec = saved_codec(new_version, wrtdir, os.path.basename(new_path))
+    codec = get_codec(codec)
+    filename = 'ipr_match_delta-%i-%i.xml%s' % (old_version, new_version,
+                                                codec.suffix)
+
+    # Running options message.
+    print('Comparing ipr_reviewed_human_match-%i.xml with version %i' 
+          % (new_version, old_version))
+
+    # Only a digest of each old entry is kept in memory.
+    old_digests = {}
+    for uniprot_ac, block in protein_blocks(old_in):
+        old_digests[uniprot_ac] = hashlib.sha1(block).digest()
+    old_in.close()
+
+    n_changed = 0
+    delta_out = XmlWriter('%s/tmp-%s' % (wrtdir, filename), codec=codec)
+    delta_out.write('<interpromatch_delta from="%i" to="%i">\n' 
+                    % (old_version, new_version))
+    for uniprot_ac, block in protein_blocks(new_in):
+        digest = old_digests.pop(uniprot_ac, None)
+        if digest != hashlib.sha1(block).digest():
+            delta_out.write_record([block.decode('utf-8')])
+            n_changed += 1
+    for uniprot_ac in sorted(old_digests):
+        delta_out.write('<removed id="%s"/>\n' % uniprot_ac)
+    delta_out.write('</interpromatch_delta>\n')
+    delta_out.close()
+    new_in.close()
+
+    print('%i entries added or changed, %i entries removed.'
+          % (n_changed, len(old_digests)))
+    os.replace('%s/tmp-%s' % (wrtdir, filename), '%s/%s' % (wrtdir, filename))
+    save_record_count(new_version, wrtdir, filename, delta_out.records, 
+                      codec)
+
+
+def file_checksum(path, blocksize=1048576):
+    """ Compute the sha256 checksum of a file. """
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        block = infile.read(blocksize)
+        while block:
+            checksum.update(block)
+            block = infile.read(blocksize)
+    return checksum.hexdigest()
+
+
+def release_files(version, wrtdir):
+    """ 
+    List the custom files of given version found in 'wrtdir', 
+    including the shards of ipr_reviewed_human_match and their directory.
+    """
+    suffix = '-%i.xml' % version
+    shard_tag = '-%i-shard' % version
+    filenames = []
+    for filename in sorted(os.listdir(wrtdir)):
+        if filename.startswith(ARTIFACT_PREFIXES) and (
+                strip_codec_suffix(filename).endswith(suffix) 
+                or shard_tag in filename):
+            filenames.append(filename)
+    return filenames
+
+
+def record_tag(filename):
+    """ Find the tag of the records of a custom xml file. """
+    if not strip_codec_suffix(filename).endswith('.xml'):
+        return None
+    for prefix, tag in RECORD_TAGS.items():
+        if filename.startswith(prefix):
+            return tag
+    return None
+
+
+def iter_records(path, tag):
+    """
+    Stream the elements with given tag of a compressed xml file.
+    Each element is cleared once the caller is done with it.
+    """
+    with open_compressed(path) as infile:
+        for event, element in etree.iterparse(infile, tag=tag):
+            yield element
+            element.clear()
+            # Also drop the references kept by the root element.
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def save_record_count(version, wrtdir, filename, records, codec):
+    """
+    Save the number of records written to custom file 'filename' and 
+    its codec with level in records-<version>.json, for the manifest 
+    of that version.
+    """
+    counts = read_record_counts(version, wrtdir)
+    counts[filename] = {'records': records, 'codec': str(codec)}
+    path = '%s/records-%i.json' % (wrtdir, version)
+    with open('%s.tmp' % path, 'w') as outfile:
+        json.dump(counts, outfile, indent=1, sort_keys=True)
+    os.replace('%s.tmp' % path, path)
+
+
+def read_record_counts(version, wrtdir):
+    """ Read file records-<version>.json, empty if it does not exist. """
+    try:
+        with open('%s/records-%i.json' % (wrtdir, version)) as infile:
+            counts = json.load(infile)
+    except FileNotFoundError:
+        return {}
+    # Older files hold only the number of records, the codec is unknown.
+    for filename, saved in counts.items():
+        if not isinstance(saved, dict):
+            counts[filename] = {'records': saved, 'codec': ''}
+    return counts
+
+
+def saved_codec(version, wrtdir, filename):
+    """
+    Codec specification, with level, that custom file 'filename' was 
+    written with. The level of a file not found in records-<version>.json 
+    is unknown, its codec is then recognized from its first bytes.
+    """
+    codec = detect_codec('%s/%s' % (wrtdir, filename))
+    saved = read_record_counts(version, wrtdir).get(filename)
+    if saved and saved['codec'].partition(':')[0] == codec:
+        return saved['codec']
+    return codec
+
+
+def write_manifest(version, wrtdir):
+    """
+    Write file manifest-tmp-<version>.json that contains the size, 
+    sha256 checksum and codec of each custom file of given version, 
+    and the compression level and number of records saved by its writer. Files are not 
+    parsed here, problems in their content are found by verify_outputs.
+    The manifest is renamed manifest-<version>.json by commit_manifest 
+    once the files pass verification.
+    """
+    counts = read_record_counts(version, wrtdir)
+    files = {}
+    for filename in release_files(version, wrtdir):
+        path = '%s/%s' % (wrtdir, filename)
+        files[filename] = {'size': os.path.getsize(path),
+                           'sha256': file_checksum(path),
+                           'codec': detect_codec(path)}
+        if filename in counts:
+            files[filename]['records'] = counts[filename]['records']
+            name, colon, level = counts[filename]['codec'].partition(':')
+            if name == files[filename]['codec'] and level:
+                files[filename]['level'] = int(level)
+    manifest = {'version': version, 'files': files}
+
+    with open('%s/manifest-tmp-%i.json' % (wrtdir, version), 'w') as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+    return manifest
+
+
+def commit_manifest(version, wrtdir):
+    """ Put the verified manifest-tmp-<version>.json in place. """
+    os.replace('%s/manifest-tmp-%i.json' % (wrtdir, version),
+               '%s/manifest-%i.json' % (wrtdir, version))
+
+
+def discard_manifest(version, wrtdir):
+    """ Remove manifest-tmp-<version>.json after a failed verification. """
+    os.remove('%s/manifest-tmp-%i.json' % (wrtdir, version))
+
+
+def read_manifest(version, wrtdir):
+    """ Read file manifest-<version>.json. """
+    with open('%s/manifest-%i.json' % (wrtdir, version)) as infile:
+        return json.load(infile)
+# ###########################################################################
+
+
+
+# 8. Verify the custom files of a version before they are published.
+#
+# Every file listed in the manifest is read in a separate process, to check 
+# its size and checksum, the integrity of the compressed stream, that the xml is 
+# well formed and that the number of records agrees with the manifest.
+# Then the accessions of uniprot-entries are searched in the match file and 
+# the ids of the match file are compared with the isoforms of refs_mapping.
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+
+def check_artifact(wrtdir, filename, info):
+    """
+    Check one custom file against its manifest entry 'info'.
+    Return the file name, the list of problems found, the ids of its 
+    records and, for refs_mapping, the length of each isoform.
+    """
+    path = '%s/%s' % (wrtdir, filename)
+    problems = []
+    ids = set()
+    isoforms = {}
+
+    if not os.path.exists(path):
+        return filename, ['%s: file is missing.' % filename], ids, isoforms
+    if os.path.getsize(path) != info['size']:
+        problems.append('%s: size differs from manifest.' % filename)
+    elif file_checksum(path) != info['sha256']:
+        problems.append('%s: checksum differs from manifest.' % filename)
+
+    tag = record_tag(filename)
+    if tag is None:
+        return filename, problems, ids, isoforms
+
+    records = 0
+    try:
+        for element in iter_records(path, tag):
+            records += 1
+            if tag == 'entry':
+                ids.add(element.get('uniprot_ac'))
+                for isoform in element.iterfind('isoform'):
+                    isoforms[isoform.findtext('id')] = (
+                        isoform.findtext('length'))
+            else:
+                ids.add(element.get('id'))
+    except STREAM_ERRORS as error:
+        problems.append('%s: corrupted compressed stream (%s).' 
+                        % (filename, error))
+    except etree.XMLSyntaxError as error:
+        problems.append('%s: malformed xml (%s).' % (filename, error))
+    else:
+        if 'records' in info and records != info['records']:
+            problems.append('%s: %i records, %i expected from manifest.'
+                            % (filename, records, info['records']))
+
+    return filename, problems, ids, isoforms
+
+
+def id_problem(message, ids):
+    """ Format a problem about a list of ids, showing the first ones. """
+    ids = sorted(ids)
+    shown = ' '.join(ids[:10])
+    if len(ids) > 10:
+        shown += ' ...'
+    return '%i %s: %s' % (len(ids), message, shown)
+
+
+def verify_outputs(version, wrtdir, jobs=4, manifest=None):
+    """
+    Verify the custom files of given version listed in its manifest, 
+    or in 'manifest' if given (a manifest not yet committed).
+    Return the list of problems found, empty if everything is fine.
+    """
+    if manifest is None:
+        manifest = read_manifest(version, wrtdir)
+    filenames = sorted(manifest['files'])
+    problems = []
+    ids = {}
+    isoforms = {}
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(check_artifact, wrtdir, filename,
+                                   manifest['files'][filename])
+                   for filename in filenames]
+        for future in futures:
+            filename, file_problems, file_ids, file_isoforms = future.result()
+            problems += file_problems
+            ids[filename] = file_ids
+            isoforms.update(file_isoforms)
+
+    # Cross-check accessions and isoforms.
+    names = dict((strip_codec_suffix(filename), filename) 
+                 for filename in filenames)
+    match_name = names.get('ipr_reviewed_human_match-%i.xml' % version)
+    mapping_name = names.get('refs_mapping-%i.xml' % version)
+    match_ids = ids.get(match_name, set())
+
+    for filename in sorted(os.listdir(wrtdir)):
+        if filename.startswith('uniprot-entries-%i-' % version):
+            with open('%s/%s' % (wrtdir, filename)) as entries_in:
+                entries = [line.split()[1] for line in entries_in]
+            missing = set(entries) - match_ids
+            if match_name in ids and missing:
+                problems.append(id_problem('accessions of %s missing from %s'
+                                           % (filename, match_name), missing))
+
+    if match_name in ids and mapping_name in ids:
+        mapping_ids = ids[mapping_name]
+        unknown = [match_id for match_id in match_ids
+                   if (match_id not in isoforms if '-' in match_id 
+                       else match_id not in mapping_ids)]
+        if unknown:
+            problems.append(id_problem('ids of %s not found in %s'
+                                       % (match_name, mapping_name), unknown))
+
+    no_length = [isoform for isoform, length in isoforms.items()
+                 if not length or not length.isdigit() or int(length) == 0]
+    if no_length:
+        problems.append(id_problem('isoforms of %s without length' 
+                                   % mapping_name, no_length))
+
+    return problems
+# %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
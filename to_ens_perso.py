@@ -1,147 +1,256 @@
 #! /usr/bin/python3
 
 # Send the latest version of refs_mapping.xml.gz, ipr_shortnames.xml.gz
-# and ipr_reviewed_human_match.xml.gz to ENS personnal page using lftp.
+# and ipr_reviewed_human_match.xml.gz to ENS personnal page.
+# Files may be compressed with any codec of ipr_updater (.gz, .xz, .zst),
+# the codec of each file is recorded in the manifest.
+#
+# The local manifest written by update_ipr.py is compared with the manifest
+# found on the remote site, and only the files that are missing or changed
+# on the remote are sent, through several FTP connections in parallel.
+# The script asks no question, so it can run unattended. The FTP password
+# is read from environment variable ENS_FTP_PASSWORD when it is set.
 
 import os
+import sys
+import json
+import ftplib
+import getpass
+import argparse
 import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 import ipr_updater as ipru
-import lxml.html
-from lxml import etree
 
-# Local directory where custom files were written by update_ipr.py. 
+# Local directory where custom files were written by update_ipr.py.
 writedir = 'anatomizer_ipr_files'
 # Remote directory where files are stored to be available for download.
 ftpdir = 'anatomizer_ipr_files'
+ftphost = 'perso.ens-lyon.fr'
+ftpuser = 'slegare'
+httpurl = 'http://perso.ens-lyon.fr/sebastien.legare/%s/' % ftpdir
 
+# Prefixes of the full match file and of the delta files.
+match_prefix = 'ipr_reviewed_human_match-'
+delta_prefix = 'ipr_match_delta-'
 
-def remote_version(file_list):
-    """ 
-    Check the latest version of a list of files.
+
+def remote_manifest(url, cachefile=None):
+    """
+    Read the manifest of the files already on the remote site.
+    Return an empty manifest if the remote site has none.
+    With a 'cachefile', an unchanged manifest is not downloaded again.
+    """
+    try:
+        return ipru.cached_probe('%smanifest.json' % url, parse_manifest,
+                                 cachefile, ttl=0)
+    except urllib.error.HTTPError as error:
+        if error.code == 404:
+            return {'version': 0, 'files': {}}
+        raise
+    except urllib.error.URLError as error:
+        if isinstance(error.reason, FileNotFoundError):
+            return {'version': 0, 'files': {}}
+        raise
+
+
+def parse_manifest(content):
+    """ Read a manifest from json content. """
+    return json.loads(content.decode('utf-8'))
+
+
+def remote_versions(remote):
+    """
+    Versions of ipr_reviewed_human_match that can be rebuilt from the 
+    remote files: full files, and deltas whose base can itself be rebuilt.
+    """
+    versions = set()
+    deltas = []
+    for filename in remote['files']:
+        name = ipru.strip_codec_suffix(filename)[:-len('.xml')]
+        if name.startswith(match_prefix):
+            version = name[len(match_prefix):]
+            # Shards of the match file do not count.
+            if version.isdigit():
+                versions.add(int(version))
+        elif name.startswith(delta_prefix):
+            old, new = name[len(delta_prefix):].split('-')
+            deltas.append((int(old), int(new)))
+    for old, new in sorted(deltas):
+        if old in versions:
+            versions.add(new)
+    return versions
+
+
+def replaced_by_delta(local, remote):
+    """
+    List the files of the local manifest that can be replaced by the delta
+    file of their version: the full ipr_reviewed_human_match file, its 
+    shards and their directory. The delta file must be in the local 
+    manifest and its base version must be on the remote site. Return an
+    empty list if the full file has to be sent.
+    Users rebuild the full file with ipr_reader.apply_match_delta.
+    """
+    version = local['version']
+    shard_tag = '%s%i-shard' % (match_prefix, version)
+    for filename in local['files']:
+        name = ipru.strip_codec_suffix(filename)
+        if (name.startswith(delta_prefix) 
+                and name.endswith('-%i.xml' % version)
+                and int(name[len(delta_prefix):].split('-')[0]) 
+                in remote_versions(remote)):
+            return [filename for filename in local['files']
+                    if ipru.strip_codec_suffix(filename) 
+                    == '%s%i.xml' % (match_prefix, version)
+                    or filename.startswith(shard_tag)]
+    return []
+
+
+def files_to_send(local, remote, delta=False):
+    """
+    List the files of the local manifest that are missing or
+    have a different checksum in the remote manifest.
+    If 'delta' is True, the full ipr_reviewed_human_match file and its 
+    shards are skipped when the delta file can be used instead 
+    (see replaced_by_delta).
+    """
+    replaced = []
+    if delta:
+        replaced = replaced_by_delta(local, remote)
+        if not replaced:
+            print('No delta file usable with the remote site, '
+                  'the full match file is sent.')
+    sendlist = []
+    for filename, info in sorted(local['files'].items()):
+        if filename in replaced:
+            continue
+        remote_info = remote['files'].get(filename)
+        if remote_info is None or remote_info['sha256'] != info['sha256']:
+            sendlist.append(filename)
+    return sendlist
+
+
+def ftp_put(localpath, filename, host, user, password, remotedir):
     """
-    match_versions = []
-    for file_name in file_list:
-       # Find version as first series of int characters.
-       start = 0
-       for i in range(len(file_name)):
-           try:
-               x = int(file_name[i])
-               start = i-1
-           except:
-               pass
-
-           if start > 0:
-               try:
-                   x = int(file_name[i])
-               except:
-                   end = i
-                   break
-
-       version = int(file_name[start:end])
-       match_versions.append(version)
-    if len(match_versions) > 0:
-        sorted_versions = sorted(match_versions)
-        rem_version = sorted_versions[-1]
-    else:
-        rem_version = 0
-
-    return rem_version
-
-
-# Find latest version of InterPro files on local directory "writedir".
-# ---------------------------------------------------------------------------
-mapping_version = ipru.local_version(writedir,
-                                     'refs_mapping-', 'xml.gz')
-
-shortname_version = ipru.local_version(writedir,
-                                       'ipr_shortnames-', 'xml.gz')
-
-match_version = ipru.local_version(writedir,
-                                   'ipr_reviewed_human_match-',
-                                   'xml.gz', 'copy')
-
-if mapping_version != shortname_version or mapping_version != match_version:
-    raise ipru.IprUpdaterError('Latest version of each file does not match.')
-# ---------------------------------------------------------------------------
-
-
-# Find latest version of InterPro files on remote site perso.ens-lyon.fr
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-enspage = urllib.request.urlopen('http://perso.ens-lyon.fr/sebastien.legare/%s/' % ftpdir)
-content = enspage.read()
-tree = lxml.etree.HTML(content)
-entries = tree.findall('.//a')
-
-mapping_files = []
-shortname_files = []
-match_files = []
-for entry in entries:
-    field = entry.text
-    if 'refs_mapping-' in field and 'xml.gz' in field:
-        mapping_files.append(field)
-    if 'ipr_shortnames-' in field and 'xml.gz' in field:
-        shortname_files.append(field)
-    if 'ipr_reviewed_human_match-' in field and 'xml.gz' in field:
-        match_files.append(field)
-
-rem_mapping_version = remote_version(mapping_files)
-rem_shortname_version = remote_version(shortname_files)
-rem_match_version = remote_version(match_files)
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-# Build lftp command line.
-# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-cmd_string = "lftp -u slegare perso.ens-lyon.fr -e 'cd %s;" % ftpdir
-
-# Ask user if he wants to overwrite existing files on remote site.
-# refs_mapping
-send = False
-
-exist = False
-ask = 'n'
-overwrite = False
-if rem_mapping_version == mapping_version:
-    exist = True
-    ask = input('file refs_mapping-%i.xml.gz already exists on remote. Overwrite it? [y/N] ' % mapping_version)
-    if ask.lower() == 'y' or ask.lower() == 'yes':
-        overwrite = True
-if not exist or overwrite:
-    cmd_string = cmd_string + """ echo "transfering refs_mapping-%i.xml.gz"; """ % mapping_version
-    cmd_string = cmd_string + " put %s/refs_mapping-%i.xml.gz;" % (writedir, mapping_version)
-    send = True
-
-# ipr_shortnames
-exist = False
-ask = 'n'
-overwrite = False
-if rem_shortname_version == shortname_version:
-    exist = True
-    ask = input('file ipr_shortnames-%i.xml.gz already exists on remote. Overwrite it? [y/N] ' % shortname_version)
-if ask.lower() == 'y' or ask.lower() == 'yes':
-    overwrite = True
-if not exist or overwrite:
-    cmd_string = cmd_string + """ echo "transfering ipr_shortnames-%i.xml.gz"; """ % shortname_version
-    cmd_string = cmd_string + " put %s/ipr_shortnames-%i.xml.gz;" % (writedir, shortname_version)
-    send = True
-
-# ipr_reviewed_human_match
-exist = False
-ask = 'n'
-overwrite = False
-if rem_match_version == match_version:
-    exist = True
-    ask = input('file ipr_reviewed_human_match-%i.xml.gz already exists on remote. Overwrite it? [y/N] ' % match_version)
-if ask.lower() == 'y' or ask.lower() == 'yes':
-    overwrite = True
-if not exist or overwrite:
-    cmd_string = cmd_string + """ echo "transfering ipr_reviewed_human_match-%i.xml.gz"; """ % match_version
-    cmd_string = cmd_string + " put %s/ipr_reviewed_human_match-%i.xml.gz;" % (writedir, match_version)
-    send = True
-
-cmd_string = cmd_string + " quit'"
-# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-
-# Run lftp
-if send:
-    os.system(cmd_string)
+    Send one file with its own FTP connection. The file is written under
+    a temporary name and renamed, so that it never appears half sent.
+    """
+    with ftplib.FTP(host) as ftp:
+        ftp.login(user, password)
+        ftp.cwd(remotedir)
+        with open(localpath, 'rb') as infile:
+            ftp.storbinary('STOR %s.part' % filename, infile, 1048576)
+        ftp.rename('%s.part' % filename, filename)
+    return filename
+
+
+def publish(version, wrtdir, url, host, user, password, remotedir,
+            delta=False, jobs=4, dry_run=False, verify=True):
+    """
+    Send the files of given version that are not already on the remote site,
+    then send the updated remote manifest. Return the list of sent files.
+    If 'verify' is True, nothing is sent unless the local files pass 
+    ipr_updater.verify_outputs.
+    """
+    written = False
+    try:
+        local = ipru.read_manifest(version, wrtdir)
+    except FileNotFoundError:
+        local = ipru.write_manifest(version, wrtdir)
+        written = True
+
+    if verify:
+        problems = ipru.verify_outputs(version, wrtdir, jobs, local)
+        for problem in problems:
+            print(problem)
+        if problems:
+            if written:
+                ipru.discard_manifest(version, wrtdir)
+            raise ipru.IprUpdaterError('Verification of version %i failed, '
+                                       'nothing was sent.' % version)
+    if written:
+        ipru.commit_manifest(version, wrtdir)
+    remote = remote_manifest(url, '%s/remote_probe.json' % wrtdir)
+
+    sendlist = files_to_send(local, remote, delta)
+    for filename in sorted(set(local['files']) - set(sendlist)):
+        print('file %s is skipped or already on remote.' % filename)
+    if len(sendlist) == 0 or dry_run:
+        for filename in sendlist:
+            print('file %s would be sent.' % filename)
+        return sendlist
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for filename in sendlist:
+            print('transfering %s' % filename)
+            futures.append(executor.submit(ftp_put, '%s/%s'
+                                           % (wrtdir, filename), filename,
+                                           host, user, password, remotedir))
+        for future in futures:
+            print('%s sent.' % future.result())
+
+    # The remote manifest is sent last, once all files are in place.
+    for filename in sendlist:
+        remote['files'][filename] = local['files'][filename]
+    remote['version'] = max(remote.get('version', 0), version)
+    manifest_path = '%s/manifest-remote-%i.json' % (wrtdir, version)
+    with open(manifest_path, 'w') as outfile:
+        json.dump(remote, outfile, indent=1, sort_keys=True)
+    ftp_put(manifest_path, 'manifest.json', host, user, password, remotedir)
+    os.remove(manifest_path)
+
+    return sendlist
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Send custom InterPro '
+                                     'files to the remote site.')
+    parser.add_argument('--delta', action='store_true',
+                        help='send the release-to-release delta instead '
+                        'of the full ipr_reviewed_human_match file, when '
+                        'the remote site has its base version')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='number of parallel uploads (default 4)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the files that would be sent')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='send files without verifying them first')
+    parser.add_argument('--writedir', default=writedir)
+    parser.add_argument('--url', default=httpurl,
+                        help='url where the remote files can be read')
+    parser.add_argument('--host', default=ftphost)
+    parser.add_argument('--user', default=ftpuser)
+    parser.add_argument('--remotedir', default=ftpdir)
+    args = parser.parse_args()
+
+    # Find latest version of InterPro files on local directory.
+    # -----------------------------------------------------------------------
+    mapping_version = ipru.local_version(args.writedir,
+                                         'refs_mapping-', '.xml')
+
+    shortname_version = ipru.local_version(args.writedir,
+                                           'ipr_shortnames-', '.xml')
+
+    match_version = ipru.local_version(args.writedir,
+                                       'ipr_reviewed_human_match-',
+                                       '.xml', 'copy')
+
+    if (mapping_version != shortname_version
+            or mapping_version != match_version):
+        raise ipru.IprUpdaterError('Latest version of each file does '
+                                   'not match.')
+    # -----------------------------------------------------------------------
+
+    password = os.environ.get('ENS_FTP_PASSWORD')
+    if password is None and not args.dry_run:
+        if not sys.stdin.isatty():
+            raise ipru.IprUpdaterError('Set ENS_FTP_PASSWORD to run '
+                                       'without a terminal.')
+        password = getpass.getpass('Password for %s@%s: '
+                                   % (args.user, args.host))
 
+    publish(mapping_version, args.writedir, args.url, args.host, args.user,
+            password, args.remotedir, args.delta, args.jobs, args.dry_run,
+            not args.no_verify)
@@ -15,145 +15,306 @@ import gzip
 import csv
 import shutil
 import urllib.request # "import requests" does not work for FTP
+import argparse
 import lxml.html
 from lxml import etree
 
 import ipr_updater as ipru
 
 
-# Check if final output files already exist.
-ipr_version = ipru.online_version()
-
-
-## Create necessary directories if they do not exist
-downldir = 'downloaded_files' # Directory to put downloaded files.
-writedir = 'anatomizer_ipr_files' # Directory to write custom files.
-ipru.ipr_mkdir(downldir, writedir)
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-
-# --------- Fetch files ----------
-today = time.strftime("%d%b%Y")
-
-# Interpro
-interpro_version = ipru.local_version(downldir,
-                                      'interpro-', 'xml.gz')
-
-if interpro_version < ipr_version:
-    print('Downloading file 1 of 4 interpro-%i.xml.gz to %s/'
-          % (ipr_version, downldir) )
-    ipru.fetch_interpro(ipr_version, downldir)
-    print('')
-else:
-    print('File 1 of 4 interpro-%i.xml.gz already in %s/\n'
-          % (ipr_version, downldir) )
-
-
-# Match
-match_version = ipru.local_version(downldir,
-                                   'match_complete-', 'xml.gz')
-
-if match_version < ipr_version:
-    print('Downloading file 2 of 4 match_complete-%i.xml.gz to %s/'
-          % (ipr_version, downldir) )
-    ipru.fetch_match(ipr_version, downldir)
-    print('')
-else:
-    print('File 2 of 4 match_complete-%i.xml.gz already in %s/'
-          % (ipr_version, downldir) )
-    file_byte = os.path.getsize('%s/match_complete-%i.xml.gz'
-                                % (downldir, ipr_version) )
-    filesize = ipru.convert_size(file_byte)
-    print("This file's size is %s. It should be at least 15 GB.\n"
-          % filesize)
-
-
-# TSV
-tsv_version = ipru.local_version(downldir,
-                                 'uniprot-hproteome-', 'tsv.gz')
-
-if tsv_version < ipr_version:
-    print('Downloading file 3 of 4 uniprot-hproteome-%i-%s.tsv.gz to %s/'
-          % (ipr_version, today, downldir) )
-    print('This should take about a minute.')
-    ipru.fetch_tsv(ipr_version, downldir, today)
-    print('')
-else:
-    print('File 3 of 4 uniprot-hproteome-%i.tsv.gz already in %s/\n'
-          % (ipr_version, downldir) )
-
-
-# FASTA
-fasta_version = ipru.local_version(downldir,
-                                   'uniprot-hproteome-', 'fasta.gz')
-
-if fasta_version < ipr_version:
-    print('Downloading file 4 of 4 uniprot-hproteome-%i-%s.fasta.gz to %s/'
-          % (ipr_version, today, downldir) )
-    print('This should take about a minute.')
-    ipru.fetch_fasta(ipr_version, downldir, today)
+# Custom files that can be given their own codec with --codec FILE=CODEC.
+codec_files = [prefix[:-1] for prefix in ipru.ARTIFACT_PREFIXES]
+
+
+def parse_codecs(specs):
+    """
+    Read the --codec options into a dictionary from custom file 
+    ('' for all files) to Codec. Unknown files and codecs, and levels
+    out of range, are rejected.
+    """
+    codecs = {}
+    for spec in specs:
+        artifact, equal, codec = spec.rpartition('=')
+        if equal and artifact not in codec_files:
+            raise ipru.IprUpdaterError('Unknown file %s in --codec %s, '
+                                       'expected one of %s.' 
+                                       % (artifact, spec, 
+                                          ', '.join(codec_files)))
+        codecs[artifact] = ipru.get_codec(codec)
+    return codecs
+
+
+def codec_for(codecs, artifact):
+    """ Codec given for a custom file, or for all files, else None. """
+    return codecs.get(artifact, codecs.get(''))
+
+
+def output_name(codecs, artifact, version, default=None):
+    """ 
+    Name of a custom file about to be written, with the suffix of its 
+    codec ('default' if none was given for it, gzip if None).
+    """
+    codec = ipru.get_codec(codec_for(codecs, artifact) or default)
+    return '%s-%s.xml%s' % (artifact, version, codec.suffix)
+
+
+def local_name(wrtdir, artifact, version):
+    """ Name of a custom file already written, whatever its codec. """
+    return os.path.basename(ipru.find_artifact(wrtdir, '%s-%s.xml' 
+                                               % (artifact, version)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Update custom InterPro files.')
+    parser.add_argument('--check', action='store_true',
+                        help='only check if there is a new version to '
+                        'process, exit with status 0 if there is one and 1 '
+                        'otherwise')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='also split ipr_reviewed_human_match in that '
+                        'many files by range of accessions')
+    parser.add_argument('--merge-mapping', action='store_true',
+                        help='write refs_mapping by walking the sorted fasta '
+                        'and tsv files in lockstep, with constant memory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='scan match_complete.xml.gz with that many '
+                        'processes (needs a file written in several gzip '
+                        'members)')
+    parser.add_argument('--codec', action='append', default=[],
+                        metavar='[FILE=]CODEC[:LEVEL]',
+                        help='compression of the custom files: gzip '
+                        '(default), bgzf, xz, zstd or none, with an optional '
+                        'level (0-9, 1-22 for zstd); FILE= restricts it to one file, e.g. '
+                        'ipr_reviewed_human_match=bgzf (may be repeated)')
+    args = parser.parse_args()
+
+    # Codec of each custom file, checked before any work is done.
+    codecs = parse_codecs(args.codec)
+
+
+    ## Create necessary directories if they do not exist
+    downldir = 'downloaded_files' # Directory to put downloaded files.
+    writedir = 'anatomizer_ipr_files' # Directory to write custom files.
+    ipru.ipr_mkdir(downldir, writedir)
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    # Online version is cached and revalidated with a conditional request.
+    probe_cache = '%s/version_probe.json' % downldir
+
+    if args.check:
+        if ipru.needs_update(writedir, probe_cache):
+            print('A new InterPro version is available.')
+            sys.exit(0)
+        print('Custom InterPro files are up to date.')
+        sys.exit(1)
+
+    # Check if final output files already exist.
+    ipr_version = ipru.online_version(probe_cache)
+
+
+    # --------- Fetch files ----------
+    today = time.strftime("%d%b%Y")
+
+    # Interpro
+    # An uncompressed copy (interpro-N.xml) is also accepted.
+    interpro_version = ipru.local_version(downldir,
+                                          'interpro-', '.xml')
+
+    if interpro_version < ipr_version:
+        print('Downloading file 1 of 4 interpro-%i.xml.gz to %s/'
+              % (ipr_version, downldir) )
+        ipru.fetch_interpro(ipr_version, downldir)
+        print('')
+    else:
+        print('File 1 of 4 interpro-%i.xml.gz already in %s/\n'
+              % (ipr_version, downldir) )
+
+
+    # Match
+    # An uncompressed copy (match_complete-N.xml) is also accepted.
+    match_version = ipru.local_version(downldir,
+                                       'match_complete-', '.xml')
+
+    if match_version < ipr_version:
+        print('Downloading file 2 of 4 match_complete-%i.xml.gz to %s/'
+              % (ipr_version, downldir) )
+        ipru.fetch_match(ipr_version, downldir)
+        print('')
+    else:
+        match_path = ipru.input_path('%s/match_complete-%i.xml.gz'
+                                     % (downldir, ipr_version) )
+        print('File 2 of 4 %s already in %s/'
+              % (os.path.basename(match_path), downldir) )
+        file_byte = os.path.getsize(match_path)
+        filesize = ipru.convert_size(file_byte)
+        print("This file's size is %s. It should be at least 15 GB.\n"
+              % filesize)
+
+
+    # TSV
+    tsv_version = ipru.local_version(downldir,
+                                     'uniprot-hproteome-', 'tsv.gz')
+
+    if tsv_version < ipr_version:
+        print('Downloading file 3 of 4 uniprot-hproteome-%i-%s.tsv.gz to %s/'
+              % (ipr_version, today, downldir) )
+        print('This should take about a minute.')
+        ipru.fetch_tsv(ipr_version, downldir, today)
+        print('')
+    else:
+        print('File 3 of 4 uniprot-hproteome-%i.tsv.gz already in %s/\n'
+              % (ipr_version, downldir) )
+
+
+    # FASTA
+    fasta_version = ipru.local_version(downldir,
+                                       'uniprot-hproteome-', 'fasta.gz')
+
+    if fasta_version < ipr_version:
+        print('Downloading file 4 of 4 uniprot-hproteome-%i-%s.fasta.gz to %s/'
+              % (ipr_version, today, downldir) )
+        print('This should take about a minute.')
+        ipru.fetch_fasta(ipr_version, downldir, today)
+        print('')
+    else:
+        print('File 4 of 4 uniprot-hproteome-%i.fasta.gz already in %s/\n'
+              % (ipr_version, downldir) )
+
+    # --------------------------------
+
+
+    print(' ---- Finished fetching files. Now writing custom files. ----\n')
+
+
+    ## ====== Write custom files ======
+
+    # Mapping
+    mapping_version = ipru.local_version(writedir, 
+                                         'refs_mapping-', '.xml')
+    if mapping_version < ipr_version:
+        print('Writing file 1 of 4 %s to %s/'
+              % (output_name(codecs, 'refs_mapping', ipr_version), 
+                 writedir) )
+        ipru.update_mapping(ipr_version, downldir, writedir, 
+                            args.merge_mapping, 
+                            codec_for(codecs, 'refs_mapping'))
+        print('')
+    else:
+        print('File 1 of 4 %s already in %s/\n'
+              % (local_name(writedir, 'refs_mapping', ipr_version), 
+                 writedir) )
+
+    # Short names
+    shortname_version = ipru.local_version(writedir, 
+                                           'ipr_shortnames-', '.xml')
+    if shortname_version < ipr_version:
+        print('Writing file 2 of 4 %s to %s/'
+              % (output_name(codecs, 'ipr_shortnames', ipr_version), 
+                 writedir) )
+        ipru.update_shortname(ipr_version, downldir, writedir, 
+                              codec=codec_for(codecs, 'ipr_shortnames'),
+                              hierarchy_codec=codec_for(codecs, 
+                                                        'ipr_hierarchy'))
+        print('')
+    else:
+        print('File 2 of 4 %s already in %s/\n'
+              % (local_name(writedir, 'ipr_shortnames', ipr_version), 
+                 writedir) )
+
+    # Matching
+    matching_version = ipru.local_version(writedir, 
+                                          'ipr_reviewed_human_match-', '.xml')
+    if matching_version < ipr_version:
+        print('Writing file 3 of 4 %s to %s/'
+              % (output_name(codecs, 'ipr_reviewed_human_match', 
+                             ipr_version), writedir) )
+        ipru.update_match(ipr_version, downldir, writedir, args.shards,
+                          args.workers, 
+                          codec_for(codecs, 'ipr_reviewed_human_match'))
+        print('')
+    else:
+        print('File 3 of 4 %s already in %s/\n'
+              % (local_name(writedir, 'ipr_reviewed_human_match', 
+                            ipr_version), writedir) )
+
+    # Files derived from the match file use its codec by default.
+    match_codec = ipru.detect_codec(ipru.find_artifact(
+        writedir, 'ipr_reviewed_human_match-%i.xml' % ipr_version))
+
+    # Extracting canonicals
+    canon_version = ipru.local_version(writedir,
+                                       'ipr_canonical_human_match-', '.xml')
+    if canon_version < ipr_version:
+        print('Writing file 4 of 4 %s to %s/'
+              % (output_name(codecs, 'ipr_canonical_human_match', 
+                             ipr_version, match_codec), writedir) )
+        ipru.extract_canon(ipr_version, writedir, 
+                           codec_for(codecs, 'ipr_canonical_human_match'))
+        print('')
+    else:
+        print('File 4 of 4 %s already in %s/\n'
+              % (local_name(writedir, 'ipr_canonical_human_match', 
+                            ipr_version), writedir) )
+
+    # Domain summary
+    summary_version = ipru.local_version(writedir,
+                                         'ipr_domain_summary-', '.xml')
+    if summary_version < ipr_version:
+        print('Writing file %s to %s/'
+              % (output_name(codecs, 'ipr_domain_summary', ipr_version, 
+                             match_codec), writedir) )
+        ipru.update_domain_summary(ipr_version, writedir, 
+                                   codec_for(codecs, 'ipr_domain_summary'))
+        print('')
+    else:
+        print('File %s already in %s/\n'
+              % (local_name(writedir, 'ipr_domain_summary', ipr_version), 
+                 writedir) )
+
+    # Delta with the previous version of ipr_reviewed_human_match found
+    # in the directory, also written by a run resumed after a failure.
+    previous = [version for version in ipru.file_versions(
+                    writedir, 'ipr_reviewed_human_match-', '.xml')
+                if version < ipr_version]
+    if previous:
+        delta_version = '%i-%i' % (previous[-1], ipr_version)
+        if ipr_version not in ipru.file_versions(
+                writedir, 'ipr_match_delta-%i-' % previous[-1], '.xml'):
+            print('Writing file %s to %s/'
+                  % (output_name(codecs, 'ipr_match_delta', delta_version, 
+                                 match_codec), writedir) )
+            ipru.write_match_delta(previous[-1], ipr_version, writedir,
+                                   codec_for(codecs, 'ipr_match_delta'))
+            print('')
+        else:
+            print('File %s already in %s/\n'
+                  % (local_name(writedir, 'ipr_match_delta', delta_version), 
+                     writedir) )
+
+    # Manifest of the custom files, used by to_ens_perso.py
+    print('Writing file manifest-%i.json to %s/\n' % (ipr_version, writedir) )
+    manifest = ipru.write_manifest(ipr_version, writedir)
+
+    # Verification of the custom files, the manifest is kept only if they pass
+    print('Verifying custom files of version %i' % ipr_version)
+    problems = ipru.verify_outputs(ipr_version, writedir, manifest=manifest)
+    for problem in problems:
+        print(problem)
+    if problems:
+        ipru.discard_manifest(ipr_version, writedir)
+        raise ipru.IprUpdaterError('Custom files of version %i did not pass '
+                                   'verification.' % ipr_version)
+    ipru.commit_manifest(ipr_version, writedir)
     print('')
-else:
-    print('File 4 of 4 uniprot-hproteome-%i.fasta.gz already in %s/\n'
-          % (ipr_version, downldir) )
-
-# --------------------------------
-
-
-print(' ---- Finished fetching files. Now writing custom files. ----\n')
 
+    # ================================
 
-## ====== Write custom files ======
-
-# Mapping
-mapping_version = ipru.local_version(writedir, 
-                                     'refs_mapping-', '.xml.gz')
-if mapping_version < ipr_version:
-    print('Writing file 1 of 4 refs_mapping-%i.xml.gz to %s/'
-          % (ipr_version, writedir) )
-    ipru.update_mapping(ipr_version, downldir, writedir)
-    print('')
-else:
-    print('File 1 of 4 refs_mapping-%i.xml.gz already in %s/\n'
-          % (ipr_version, writedir) )
-
-# Short names
-shortname_version = ipru.local_version(writedir, 
-                                       'ipr_shortnames-', '.xml.gz')
-if shortname_version < ipr_version:
-    print('Writing file 2 of 4 ipr_shortnames-%i.xml.gz to %s/'
-          % (ipr_version, writedir) )
-    ipru.update_shortname(ipr_version, downldir, writedir)
-    print('')
-else:
-    print('File 2 of 4 ipr_shortnames-%i.xml.gz already in %s/\n'
-          % (ipr_version, writedir) )
-
-# Matching
-matching_version = ipru.local_version(writedir, 
-                                      'ipr_reviewed_human_match-', '.xml.gz')
-if matching_version < ipr_version:
-    print('Writing file 3 of 4 ipr_reviewed_human_match-%i.xml.gz to %s/'
-          % (ipr_version, writedir) )
-    ipru.update_match(ipr_version, downldir, writedir)
-    print('')
-else:
-    print('File 3 of 4 ipr_reviewed_human_match-%i.xml.gz already in %s/\n'
-          % (ipr_version, writedir) )
-
-# Extracting canonicals
-canon_version = ipru.local_version(writedir,
-                                   'ipr_canonical_human_match-', '.xml.gz')
-if canon_version < ipr_version:
-    print('Writing file 4 of 4 ipr_canonical_human_match-%i.xml.gz to %s/'
-          % (ipr_version, writedir) )
-    ipru.extract_canon(ipr_version, writedir)
-    print('')
-else:
-    print('File 4 of 4 ipr_canonical_human_match-%i.xml.gz already in %s/\n'
-          % (ipr_version, writedir) )
-
-# ================================
+    print('Update of InterPro files to version %i completed.' % ipr_version)
 
-print('Update of InterPro files to version %i completed.' % ipr_version)
 
+# The script body only runs in the main process, since the worker 
+# processes of update_match and verify_outputs import this module again
+# with the spawn and forkserver start methods.
+if __name__ == '__main__':
+    main()